@@ -30,6 +30,8 @@ query_params = reader.QueryParams(
     only_update_cached_pages = False,
     fill_property= reader.FillPropertyParams(
         img_caption = True,
+        img_caption_backend = 'html',
+        img_caption_selenium_fallback = False,
         img_description = True,
         text_wikitext = True,
         text_html = True,
@@ -38,57 +40,51 @@ query_params = reader.QueryParams(
     early_icons_removal = True,
 )
 
+# predicates are module-level functions rather than lambdas, so that stages
+# can be sent to worker processes when preprocessing with workers > 1
+def is_on_commons(img_meta):
+    return ('on_commons' not in img_meta) or img_meta['on_commons']
+
+def is_not_icon(img_meta):
+    return ('is_icon' not in img_meta) or (not img_meta['is_icon'])
+
 ################################################################################
 
 print("Data Collection\n")
 reader.query(filename=filename, params=query_params)
 
-print("Data Preprocessing 1. Removing images not available on Commons\n")
-preprocessor.filter_img_metadata(
-    data_path=query_params.out_dir,
-    offset=query_params.offset,
-    limit=query_params.limit, 
-    debug_info=query_params.debug_info,
-    field_to_remove='on_commons',
-    predicate=lambda x: ('on_commons' not in x) or x['on_commons']
-)
-
-print("Data Preproccesing 2. Removing icons\n")
-preprocessor.filter_img_metadata(
-    data_path=query_params.out_dir,
-    offset=query_params.offset,
-    limit=query_params.limit, 
-    debug_info=query_params.debug_info,
-    field_to_remove='is_icon',
-    predicate=lambda x: ('is_icon' not in x) or (not x['is_icon'])
-)
-
-print("Data Preprocessing 3. Parsing Image Headings\n")
-preprocessor.parse_image_headings(
-    data_path=query_params.out_dir,
-    offset=query_params.offset,
-    limit=query_params.limit,
-    invalidate_cache=invalidate_headings_cache,
-    debug_info=query_params.debug_info,
-    language_code=query_params.language_code,
-)
-
-print("Data Preprocessing 4. Generating visual features\n")
-preprocessor.generate_visual_features(
-    data_path=query_params.out_dir,
-    offset=query_params.offset,
-    limit=query_params.limit,
-    invalidate_cache=invalidate_visual_features_cache,
-    debug_info=query_params.debug_info,
-)
-
-print("Data Preprocessing 5. Parse image titles\n")
-preprocessor.tokenize_image_titles(
+print("Data Preprocessing\n")
+preprocessor.run_pipeline(
     data_path=query_params.out_dir,
     offset=query_params.offset,
     limit=query_params.limit,
-    invalidate_cache=invalidate_parsed_titles_cache,
     debug_info=query_params.debug_info,
+    workers=1,
+    stages=[
+        # 1. Removing images not available on Commons
+        preprocessor.FilterStage(
+            field_to_remove='on_commons',
+            predicate=is_on_commons,
+        ),
+        # 2. Removing icons
+        preprocessor.FilterStage(
+            field_to_remove='is_icon',
+            predicate=is_not_icon,
+        ),
+        # 3. Parsing Image Headings
+        preprocessor.HeadingsStage(
+            invalidate_cache=invalidate_headings_cache,
+            language_code=query_params.language_code,
+        ),
+        # 4. Generating visual features
+        preprocessor.VisualFeaturesStage(
+            invalidate_cache=invalidate_visual_features_cache,
+        ),
+        # 5. Parse image titles
+        preprocessor.TitleTokensStage(
+            invalidate_cache=invalidate_parsed_titles_cache,
+        ),
+    ],
 )
 
 print("Dataset collection has completed.")
@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+import sys
+from pywikimm import utils
+
+################################################################################
+## Converts a dataset collected by older versions of pyWikiMM, which stored
+## text.json and meta.json double-encoded, into the current JSON format.
+## Usage: python3 migrate_dataset.py <path to dataset>
+################################################################################
+
+if len(sys.argv) != 2:
+    print('Usage: python3 migrate_dataset.py <path to dataset>')
+    sys.exit(1)
+
+migrated = utils.migrate_dataset(data_path=sys.argv[1], debug_info=True)
+print('Migrated {} files'.format(migrated))
@@ -9,7 +9,10 @@ _KNOWN_ICONS = set()
 
 if os.path.isfile(_KNOWN_ICONS_PATH):
     with open(_KNOWN_ICONS_PATH) as json_file:
-        json_obj = json.loads(json.load(json_file))
+        json_obj = json.load(json_file)
+        # older versions stored it double-encoded, i.e. as a JSON string
+        if isinstance(json_obj, str):
+            json_obj = json.loads(json_obj)
         _KNOWN_ICONS = set(json_obj['known_icons'])
 else:
     print('WARNING: missing {} file. Default to empty set.'.format(_KNOWN_ICONS_PATH))
@@ -0,0 +1,328 @@
+# from __future__ import annotations  # optional, uncomment if py.version >= 3.7
+import hashlib
+import io
+import os
+import random
+import threading
+import time
+import requests
+
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from typing import Dict, Optional, Tuple, Union
+from urllib.parse import urlsplit
+from pywikimm.utils import _get_tmp_path, _write_atomic, _dumps, _loads, JSONType
+
+pathlike = Union[str, Path]
+
+_SESSION_LOCK = threading.Lock()
+_SESSION: Optional[requests.Session] = None
+_SESSION_POOL_SIZE = 0
+
+# requests with a connect timeout and a read timeout in seconds
+_TIMEOUT = (10, 60)
+_CHUNK_SIZE = 64 * 1024
+
+# responses telling that we are sending too many requests
+_THROTTLED_STATUSES = {429, 503}
+
+# Classic token bucket: holds up to @burst tokens and refills at @rate tokens
+# per second. Every request takes a token, waiting for one if bucket is empty.
+# Besides that, the whole host can be paused, e.g. after it asked us to slow
+# down, so that all threads wait instead of retrying at once
+class _TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                else:
+                    elapsed = now - self._updated_at
+                    self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+                    self._updated_at = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+    def pause(self, delay: float) -> None:
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            self._tokens = 0.0
+
+# Per-host token buckets shared by every way we talk to Wikimedia: our own
+# session, pywikibot and Selenium. Hosts are limited independently, so e.g.
+# image downloads from upload.wikimedia.org don't slow down API requests
+class _RateLimiter:
+    def __init__(self, requests_per_second: float, burst: int, max_retries: int):
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.max_retries = max_retries
+        self._buckets: Dict[str, _TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, url: str) -> _TokenBucket:
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = _TokenBucket(self.requests_per_second, self.burst)
+            return self._buckets[host]
+
+    def acquire(self, url: str) -> None:
+        if self.requests_per_second > 0:
+            self._bucket(url).acquire()
+
+    # pauses requests to the host of @url for @delay seconds
+    def pause(self, url: str, delay: float) -> None:
+        self._bucket(url).pause(delay)
+
+_LIMITER = _RateLimiter(requests_per_second=10.0, burst=10, max_retries=5)
+
+# Returns delay in seconds requested by Retry-After header of @response, which
+# is either a number of seconds or a date, or None if there is no such header
+def _get_retry_after(response: requests.Response) -> Optional[float]:
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+# Exponential backoff with full jitter: random delay up to 2^attempt seconds,
+# so that threads throttled at the same time don't retry at the same time
+def _get_backoff(attempt: int, max_delay: float = 60.0) -> float:
+    return random.uniform(0, min(max_delay, 2 ** attempt))
+
+# Adapter which takes a token from the rate limiter before every request and
+# retries throttled responses and connection errors. Waits as long as the
+# server asked in Retry-After, otherwise backs off exponentially
+class _RateLimitedAdapter(HTTPAdapter):
+    def send(self, request, **kwargs):
+        attempt = 0
+        while True:
+            _LIMITER.acquire(request.url)
+            try:
+                response = super().send(request, **kwargs)
+            except requests.ConnectionError:
+                if attempt >= _LIMITER.max_retries:
+                    raise
+                time.sleep(_get_backoff(attempt))
+                attempt += 1
+                continue
+            
+            if (
+                response.status_code not in _THROTTLED_STATUSES
+                or attempt >= _LIMITER.max_retries
+            ):
+                return response
+            
+            retry_after = _get_retry_after(response)
+            delay = retry_after if retry_after is not None else _get_backoff(attempt)
+            print('Throttled by {}, retrying in {:.1f}s'.format(
+                urlsplit(request.url).netloc, delay
+            ))
+            _LIMITER.pause(request.url, delay)
+            response.close()
+            attempt += 1
+
+# On-disk cache of HTTP responses in @cache_dir. Every entry is a file named by
+# the hash of the request, which holds a JSON line with status and headers
+# followed by the body. Cached responses with ETag or Last-Modified are
+# revalidated with a conditional request, which costs no download if they
+# haven't changed. If @offline, responses are served from the cache only and
+# requests missing there fail without touching network
+class _HttpCache:
+    def __init__(self, cache_dir: str, offline: bool):
+        self.cache_dir = Path(cache_dir)
+        self.offline = offline
+
+    def _get_path(self, request: requests.PreparedRequest) -> Path:
+        key = hashlib.sha256()
+        for part in [request.method, request.url, request.body or b'']:
+            key.update(part.encode('utf-8') if isinstance(part, str) else part)
+        name = key.hexdigest()
+        return self.cache_dir / name[0] / name[:2] / name
+
+    def load(
+        self, request: requests.PreparedRequest
+    ) -> Optional[Tuple[JSONType, bytes]]:
+        try:
+            with open(self._get_path(request), 'rb') as f:
+                header, body = f.read().split(b'\n', 1)
+            return (_loads(header), body)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, request: requests.PreparedRequest, response: requests.Response) -> None:
+        path = self._get_path(request)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        header = {
+            'url': response.url,
+            'status': response.status_code,
+            'reason': response.reason,
+            'headers': dict(response.headers),
+        }
+        _write_atomic(path, _dumps(header) + b'\n' + response.content)
+
+    @staticmethod
+    def to_response(
+        request: requests.PreparedRequest, header: JSONType, body: bytes
+    ) -> requests.Response:
+        response = requests.Response()
+        response.request = request
+        response.url = header['url']
+        response.status_code = header['status']
+        response.reason = header['reason']
+        response.headers = CaseInsensitiveDict(header['headers'])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.raw = io.BytesIO(body)
+        response._content = body
+        response._content_consumed = True
+        return response
+
+    # adds headers asking the server to reply with 304 Not Modified, if the
+    # cached @header is still valid. Returns False if it can't be validated
+    @staticmethod
+    def add_validators(request: requests.PreparedRequest, header: JSONType) -> bool:
+        headers = CaseInsensitiveDict(header['headers'])
+        if 'ETag' in headers:
+            request.headers['If-None-Match'] = headers['ETag']
+        if 'Last-Modified' in headers:
+            request.headers['If-Modified-Since'] = headers['Last-Modified']
+        return 'ETag' in headers or 'Last-Modified' in headers
+
+    # images are already kept in the dataset itself, so only text responses,
+    # such as article HTML, description pages and API replies, are cached
+    @staticmethod
+    def is_cacheable(response: requests.Response) -> bool:
+        content_type = response.headers.get('Content-Type', '')
+        return response.status_code == 200 and not content_type.startswith('image/')
+
+_CACHE: Optional[_HttpCache] = None
+
+# Serves responses from the HTTP cache, if it's enabled, on top of the rate
+# limits and retries of _RateLimitedAdapter
+class _CachingAdapter(_RateLimitedAdapter):
+    def send(self, request, **kwargs):
+        cache = _CACHE
+        if cache is None:
+            return super().send(request, **kwargs)
+        
+        cached = cache.load(request)
+        if cache.offline:
+            if cached is None:
+                raise requests.ConnectionError(
+                    'Offline mode: {} is not in the HTTP cache'.format(request.url)
+                )
+            return cache.to_response(request, *cached)
+        
+        if cached is not None and cache.add_validators(request, cached[0]):
+            response = super().send(request, **kwargs)
+            if response.status_code == 304:
+                response.close()
+                return cache.to_response(request, *cached)
+        else:
+            response = super().send(request, **kwargs)
+            
+        if cache.is_cacheable(response):
+            cache.save(request, response)
+        return response
+
+# Enables the on-disk HTTP cache in @cache_dir for all requests to Wikimedia
+# made by this process, see _HttpCache. None disables it
+def _configure_http_cache(cache_dir: Optional[str], offline: bool = False) -> None:
+    global _CACHE
+    _CACHE = _HttpCache(cache_dir, offline) if cache_dir else None
+
+# Sets limits of all requests to Wikimedia made by this process: at most
+# @requests_per_second to a single host on average, with bursts of up to
+# @burst requests, and at most @max_retries retries of a throttled request.
+# Rate of 0 disables the limit. Also makes pywikibot use the same limits
+def _configure_rate_limit(
+    requests_per_second: float, burst: int, max_retries: int
+) -> None:
+    global _LIMITER
+    _LIMITER = _RateLimiter(requests_per_second, burst, max_retries)
+    
+    from pywikibot.comms import http
+    adapter = _CachingAdapter()
+    http.session.mount('https://', adapter)
+    http.session.mount('http://', adapter)
+
+# Takes a token for a request to @url made outside of requests, e.g. by Selenium
+def _throttle(url: str) -> None:
+    _LIMITER.acquire(url)
+
+# Returns True if @e is an error response telling that we are throttled
+def _is_throttled(e: Exception) -> bool:
+    return (
+        isinstance(e, requests.HTTPError)
+        and e.response is not None
+        and e.response.status_code in _THROTTLED_STATUSES
+    )
+
+# Returns a process-wide session which keeps connections alive between
+# requests. Connections to a single host are capped by
+# @max_connections_per_host; extra requests block until a connection is free
+def _get_session(max_connections_per_host: int) -> requests.Session:
+    global _SESSION, _SESSION_POOL_SIZE
+    with _SESSION_LOCK:
+        if _SESSION is None or _SESSION_POOL_SIZE != max_connections_per_host:
+            adapter = _CachingAdapter(
+                pool_connections=max_connections_per_host,
+                pool_maxsize=max_connections_per_host,
+                pool_block=True,
+            )
+            session = requests.Session()
+            session.headers['User-Agent'] = 'pywikimm (https://github.com/OlehOnyshchak/pyWikiMM)'
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+
+            if _SESSION is not None:
+                _SESSION.close()
+            _SESSION, _SESSION_POOL_SIZE = session, max_connections_per_host
+
+        return _SESSION
+
+# Downloads @url into @path. Data is written into a temporary file first, so
+# that an interrupted download never leaves a partial image behind
+def _download(url: str, path: pathlike, max_connections_per_host: int) -> None:
+    session = _get_session(max_connections_per_host)
+    tmp_path = _get_tmp_path(path)
+    try:
+        with session.get(url, stream=True, timeout=_TIMEOUT) as response:
+            response.raise_for_status()
+            with open(tmp_path, 'wb') as outfile:
+                for chunk in response.iter_content(chunk_size=_CHUNK_SIZE):
+                    outfile.write(chunk)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# Downloads @url and returns its body decoded as text
+def _fetch_text(url: str, max_connections_per_host: int) -> str:
+    session = _get_session(max_connections_per_host)
+    response = session.get(url, timeout=_TIMEOUT)
+    response.raise_for_status()
+    return response.content.decode('utf-8')
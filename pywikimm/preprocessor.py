@@ -6,28 +6,53 @@ import json
 import shutil
 import re
 import os
+import itertools
+import multiprocessing
+import sqlite3
+import zlib
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from bs4.element import Tag
 from pathlib import Path
-from os import listdir, mkdir
-from os.path import isfile, isdir, join, exists, abspath
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from os import mkdir
+from os.path import isfile, join, exists, abspath, dirname, basename
 from keras.preprocessing import image
 from keras.applications.resnet import ResNet152, preprocess_input
 from sklearn.model_selection import train_test_split
 from redditscore.tokenizer import CrazyTokenizer
 from urllib.parse import unquote
 from abc import ABC, abstractmethod
-from typing import Union, List, Dict, Tuple, Sequence, Callable, Any
+from typing import Union, List, Dict, Tuple, Sequence, Callable, Any, Optional
+from pywikimm.state import CrawlState, STATUS_DONE, STATUS_FAILED
 from pywikimm.utils import (
     _getJSON,
-    _dump,
+    _dump_if_changed,
+    _get_article_paths,
     _get_translated_file_label,
     _valid_img_type,
+    _get_img_index,
     _validated_limit,
     JSONSerializableType,
+    JSONType,
+    _get_shared_path,
+    _get_tmp_path,
+    _FEATURES_FILE,
 )
 
+try:
+    import lxml  # noqa: F401, much faster parser backend for BeautifulSoup
+    _HTML_PARSER = 'lxml'
+except ImportError:
+    _HTML_PARSER = 'html.parser'
+
+_HEADING_TAGS = ['h{}'.format(i) for i in range(1, 7)]
+
+# only headings and images are needed to assign headings, so the rest of the
+# article isn't even built into the tree
+_HEADINGS_STRAINER = SoupStrainer(_HEADING_TAGS + ['img'])
+
 def _is_valid_img_src(img_src: str, lang: str) -> bool:
     special_img = '//{}.wikipedia.org/wiki/Special:CentralAutoLogin/start?type=1x1'.format(lang)
     # TODO: check if we can or need to work out with maps
@@ -78,44 +103,38 @@ def _get_heading_text(tag_element: Tag) -> str:
         text = text[:text.rfind('[')]
     return text
 
-def _get_headings(tag_element: Tag) -> List[str]:
-    res = []
-    arr = [
-        (x.name, _get_heading_text(x))
-        for x in tag_element.find_all_previous(re.compile('h[1-6]'))
-    ]
-    tagname_arr = [x for x, _ in arr]
-    for i in range(1, 7):
-        tag = 'h{}'.format(i)
-        if tag not in tagname_arr:
-            continue
-    
-        parent_index = tagname_arr.index(tag)
-        res.append(arr[parent_index][1])
-        tagname_arr = tagname_arr[:parent_index]
-        
-    return res
-
+# Returns, for every image of the article, headings of the sections it's in,
+# from the top level down, e.g. ["History", "Early years"]. Document is
+# traversed once, keeping the latest heading of every level. A new heading
+# closes all sections of the same or deeper level. If the same image occurs
+# several times, headings of its last occurrence are used
 def _get_image_headings(page_html: str, lang: str) -> Dict[str, List[str]]:
-    soup = BeautifulSoup(page_html, 'html.parser')
+    soup = BeautifulSoup(page_html, _HTML_PARSER, parse_only=_HEADINGS_STRAINER)
     
     res = {}
-    for x in soup.findAll("img"):
+    stack: List[Optional[str]] = [None] * 6
+    for x in soup.find_all(_HEADING_TAGS + ['img']):
+        if x.name != 'img':
+            level = int(x.name[1]) - 1
+            stack[level] = _get_heading_text(x)
+            stack[level + 1:] = [None] * (5 - level)
+            continue
+        
         img_src = x.get('src')
         if not _is_valid_img_src(img_src, lang):
             continue
         
         img_name = _get_translated_file_label(lang) + _get_img_name(img_src, lang)
-        res[img_name] = _get_headings(x)
+        res[img_name] = [h for h in stack if h is not None]
     
     return res
 
 def _parse_img_headings(
-    page_dir: str, invalidate_cache: bool, language_code: str
+    page_dir: str,
+    meta_arr: List[JSONType],
+    invalidate_cache: bool,
+    language_code: str,
 ) -> None:
-    meta_path = join(page_dir, 'img', 'meta.json')
-    meta_arr = _getJSON(meta_path)['img_meta']
-
     if invalidate_cache:
         for m in meta_arr:
             m.pop('headings', None)
@@ -124,22 +143,16 @@ def _parse_img_headings(
     page_html = _getJSON(text_path)['html']
     
     image_headings = _get_image_headings(page_html, language_code)
+    img_index = _get_img_index(meta_arr)
     for filename, headings in image_headings.items():
         if not _valid_img_type(filename): continue
         if len(headings) == 0: continue
+        if filename not in img_index: continue
         
-        res = [
-            i for i, x in enumerate(meta_arr)
-            if unquote(x['url']).split('/wiki/')[-1] == filename
-        ]
-
-        if len(res) != 1: continue
-        i = res[0]
+        i = img_index[filename]
 
         # TODO: not update when invalidate_cache=False even though we already queried
         meta_arr[i]['headings'] = headings
-            
-    _dump(meta_path, {"img_meta": meta_arr})
 
 ################################################################################
 # Public Interface
@@ -150,60 +163,588 @@ class IMapper(ABC):
     def map(self, img_path: str) -> JSONSerializableType:
         ...
 
+    # maps all @img_paths at once. Result for an image which failed to be
+    # mapped is None. Override if the mapper benefits from batching
+    def map_batch(
+        self, img_paths: Sequence[str]
+    ) -> List[Optional[JSONSerializableType]]:
+        res = []
+        for img_path in img_paths:
+            try:
+                res.append(self.map(img_path))
+            except Exception as e:
+                print("ERROR: exception for image", img_path, '|||', str(e))
+                res.append(None)
+        return res
+
+# Images are not resized, so only images of the same shape can share a batch.
+# map_batch groups them by shape and runs the model once per @batch_size images
+# of the same shape. To bound memory, the largest group is mapped earlier once
+# 4 * @batch_size decoded images are waiting. Up to @prefetch images are
+# decoded in background threads meanwhile. The model is only loaded on the
+# first use, so that the mapper can be sent to worker processes cheaply.
+# Note that VisualFeaturesStage calls map_batch per article, and images of one
+# article rarely share a shape, so most batches hold a single image. Speedup
+# mostly comes from decoding in the background and from worker processes, see
+# run_pipeline, rather than from batching itself
 class ResNet152Mapper(IMapper):
-    def __init__(self):
-        self.model = ResNet152(weights='imagenet', include_top=False)
+    def __init__(self, batch_size: int = 16, prefetch: int = 4):
+        self._model = None
+        self.batch_size = batch_size
+        self.prefetch = prefetch
 
-    def map(self, img_path: str) -> JSONSerializableType:
-        img = image.load_img(img_path, target_size=None)
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = ResNet152(weights='imagenet', include_top=False)
+        return self._model
+
+    # the model can't be pickled, so every process loads its own copy
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state['_model'] = None
+        return state
 
+    @staticmethod
+    def _load(img_path: str) -> np.ndarray:
+        img = image.load_img(img_path, target_size=None)
         img_data = image.img_to_array(img)
-        img_data = np.expand_dims(img_data, axis=0)
-        img_data = preprocess_input(img_data)
+        return preprocess_input(img_data)
 
+    def map(self, img_path: str) -> JSONSerializableType:
+        img_data = np.expand_dims(ResNet152Mapper._load(img_path), axis=0)
         feature_tensor = self.model.predict(img_data)
-        features = ResNet152Mapper._global_max_pool_1D(feature_tensor)
-        return features
+        return ResNet152Mapper._global_max_pool_1D(feature_tensor)[0]
+
+    def map_batch(
+        self, img_paths: Sequence[str]
+    ) -> List[Optional[JSONSerializableType]]:
+        res: List[Optional[JSONSerializableType]] = [None] * len(img_paths)
+        buckets: Dict[Tuple[int, ...], List[Tuple[int, np.ndarray]]] = {}
+        
+        def predict(shape):
+            bucket = buckets.pop(shape)
+            try:
+                feature_tensor = self.model.predict(np.stack([x for _, x in bucket]))
+            except Exception as e:
+                print("ERROR: exception for batch of", len(bucket), "images |||", str(e))
+                return
+                
+            features = ResNet152Mapper._global_max_pool_1D(feature_tensor)
+            for (i, _), f in zip(bucket, features):
+                res[i] = f
+
+        with ThreadPoolExecutor(max_workers=self.prefetch) as executor:
+            loading = deque()
+            paths = iter(enumerate(img_paths))
+            for i, img_path in itertools.islice(paths, self.prefetch):
+                loading.append((i, img_path, executor.submit(self._load, img_path)))
+                
+            while len(loading) > 0:
+                i, img_path, future = loading.popleft()
+                for j, next_path in itertools.islice(paths, 1):
+                    loading.append((j, next_path, executor.submit(self._load, next_path)))
+                
+                try:
+                    img_data = future.result()
+                except Exception as e:
+                    print("ERROR: exception for image", img_path, '|||', str(e))
+                    continue
+                    
+                buckets.setdefault(img_data.shape, []).append((i, img_data))
+                if len(buckets[img_data.shape]) >= self.batch_size:
+                    predict(img_data.shape)
+                elif sum(len(x) for x in buckets.values()) >= 4 * self.batch_size:
+                    predict(max(buckets, key=lambda shape: len(buckets[shape])))
+                    
+        for shape in list(buckets):
+            predict(shape)
+            
+        return res
 
+    # max-pools tensor of shape (N, H, W, C) to N lists of C floats
     @staticmethod
-    def _global_max_pool_1D(tensor: np.ndarray) -> List[float]:
-        _,_,_,size = tensor.shape
-        return [float(tensor[:,:,:,i].max()) for i in range(size)]
+    def _global_max_pool_1D(tensor: np.ndarray) -> List[List[float]]:
+        return tensor.max(axis=(1, 2)).tolist()
 
-def generate_visual_features(
+# Single step of the preprocessing pipeline, see run_pipeline below
+class IStage(ABC):
+    # returns updated image metadata @meta_arr of the article in @article_path
+    @abstractmethod
+    def apply(
+        self, article_path: str, meta_arr: List[JSONType]
+    ) -> List[JSONType]:
+        ...
+
+    # name under which the stage progress is recorded in state.CrawlState
+    def name(self) -> str:
+        return type(self).__name__
+
+# Keeps only images for which @predicate is True and removes @field_to_remove
+# from their metadata
+class FilterStage(IStage):
+    def __init__(
+        self,
+        predicate: Callable[[Dict[str, Any]], bool],
+        field_to_remove: str,
+    ):
+        self.predicate = predicate
+        self.field_to_remove = field_to_remove
+
+    def name(self) -> str:
+        return '{}:{}'.format(type(self).__name__, self.field_to_remove)
+
+    def apply(
+        self, article_path: str, meta_arr: List[JSONType]
+    ) -> List[JSONType]:
+        meta_arr_filtered = [x for x in meta_arr if self.predicate(x)]
+        for x in meta_arr_filtered:
+            # useless fields since now it always the same
+            x.pop(self.field_to_remove, None)
+
+        return meta_arr_filtered
+
+# Fills @headings field of image metadata, which is a list containing all
+# available headings from h1 to h6
+class HeadingsStage(IStage):
+    def __init__(self, invalidate_cache: bool = False, language_code: str = 'en'):
+        self.invalidate_cache = invalidate_cache
+        self.language_code = language_code
+
+    def apply(
+        self, article_path: str, meta_arr: List[JSONType]
+    ) -> List[JSONType]:
+        _parse_img_headings(
+            article_path, meta_arr, self.invalidate_cache, self.language_code
+        )
+        return meta_arr
+
+def _get_row_checksum(row: np.ndarray) -> int:
+    return zlib.crc32(np.ascontiguousarray(row).tobytes())
+
+# Returns True if @features_row of image metadata @meta points to its features
+# in the @stored matrix. features.npy is written before meta.json, so if the
+# process is killed in between, old rows may point to a rebuilt matrix. Such
+# rows don't match @features_crc saved along with them. Metadata written by
+# older versions has no checksum and is trusted as long as the row exists
+def _is_valid_row(meta: JSONType, stored: Optional[np.ndarray]) -> bool:
+    row = meta.get('features_row')
+    if stored is None or row is None or row >= len(stored):
+        return False
+    
+    return (
+        'features_crc' not in meta or
+        _get_row_checksum(stored[row]) == meta['features_crc']
+    )
+
+def _save_npy(path: str, arr: np.ndarray) -> None:
+    tmp_path = _get_tmp_path(path)
+    try:
+        with open(tmp_path, 'wb') as outfile:
+            np.save(outfile, arr)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# Maps visual features of images with @mapper, which is ResNet152Mapper by
+# default. Mapper is only created on the first use. With @store="npy" features
+# of an article are kept as rows of a @dtype matrix in img/features.npy, and
+# image metadata only holds index of its row in @features_row field, and its
+# checksum in @features_crc to detect a row which doesn't match. With
+# @store="json" they are saved as a list of floats in @features field instead.
+# If @shared_cache is True, features are also cached in the dataset _shared
+# directory by image filename, i.e. by the hash of image name, so an image used
+# by many articles is only mapped once
+class VisualFeaturesStage(IStage):
+    def __init__(
+        self,
+        mapper: IMapper = None,
+        invalidate_cache: bool = False,
+        store: str = 'npy',
+        dtype: str = 'float32',
+        shared_cache: bool = True,
+    ):
+        if store not in ('npy', 'json'):
+            raise Exception('Unknown feature store {}. Supported values are'\
+                ' "npy" and "json"'.format(store))
+        
+        self.mapper = mapper
+        self.invalidate_cache = invalidate_cache
+        self.store = store
+        self.dtype = dtype
+        self.shared_cache = shared_cache
+
+    def _get_cache_path(self, article_path: str, filename: str) -> Path:
+        # features of different mappers are not interchangeable
+        kind = join('features', type(self.mapper).__name__)
+        return _get_shared_path(dirname(article_path), kind, filename + '.npy')
+
+    def _map(
+        self, article_path: str, filenames: List[str]
+    ) -> Dict[str, JSONSerializableType]:
+        res = {}
+        if self.shared_cache and not self.invalidate_cache:
+            for filename in filenames:
+                cache_path = self._get_cache_path(article_path, filename)
+                if cache_path.exists():
+                    res[filename] = np.load(cache_path).tolist()
+            
+        to_map = [x for x in filenames if x not in res]
+        img_paths = [join(article_path, 'img/', x) for x in to_map]
+        for filename, features in zip(to_map, self.mapper.map_batch(img_paths)):
+            if features is None:
+                continue
+            
+            res[filename] = features
+            if self.shared_cache:
+                cache_path = self._get_cache_path(article_path, filename)
+                cache_path.parent.mkdir(parents=True, exist_ok=True)
+                _save_npy(str(cache_path), np.array(features, dtype=self.dtype))
+                
+        return res
+
+    def apply(
+        self, article_path: str, meta_arr: List[JSONType]
+    ) -> List[JSONType]:
+        if self.mapper is None:
+            self.mapper = ResNet152Mapper()
+
+        store_path = join(article_path, 'img', _FEATURES_FILE)
+        stored = np.load(store_path, mmap_mode='r') if exists(store_path) else None
+        has_features = lambda meta: (
+            'features' in meta or _is_valid_row(meta, stored)
+        )
+        
+        mapped = self._map(article_path, [
+            meta['filename'] for meta in meta_arr
+            if not has_features(meta) or self.invalidate_cache
+        ])
+
+        if self.store == 'json':
+            for meta in meta_arr:
+                if meta['filename'] in mapped:
+                    meta['features'] = mapped[meta['filename']]
+                elif _is_valid_row(meta, stored):
+                    meta['features'] = stored[meta['features_row']].tolist()
+                meta.pop('features_row', None)
+                meta.pop('features_crc', None)
+            return meta_arr
+        
+        # rows are rebuilt in the order of @meta_arr, which also drops rows
+        # of images removed from metadata since the last run
+        rows = []
+        changed = len(mapped) > 0
+        with_rows = []
+        for meta in meta_arr:
+            is_valid = _is_valid_row(meta, stored)
+            # fields are updated in place, so that key order of unchanged
+            # metadata stays the same and meta.json isn't rewritten
+            row = meta.get('features_row')
+            if meta['filename'] in mapped:
+                rows.append(mapped[meta['filename']])
+            elif 'features' in meta:
+                rows.append(meta['features'])
+            elif is_valid:
+                rows.append(stored[row])
+            else:
+                meta.pop('features_row', None)
+                meta.pop('features_crc', None)
+                continue
+            
+            changed = (
+                changed or 'features' in meta or 'features_crc' not in meta or
+                row != len(rows) - 1
+            )
+            meta.pop('features', None)
+            meta['features_row'] = len(rows) - 1
+            with_rows.append(meta)
+            
+        if changed and len(rows) > 0:
+            matrix = np.array(rows, dtype=self.dtype)
+            for meta in with_rows:
+                meta['features_crc'] = _get_row_checksum(matrix[meta['features_row']])
+            _save_npy(store_path, matrix)
+        elif len(rows) == 0 and stored is not None:
+            del stored
+            os.remove(store_path)
+            
+        return meta_arr
+
+# tokenization doesn't depend on the dataset, so the cache is kept on the local
+# disk of the machine by default. SQLite locking is unreliable on network file
+# systems, such as the shared out_dir of several nodes
+_DEFAULT_TOKENS_CACHE_PATH = join(
+    os.path.expanduser('~'), '.cache', 'pywikimm', 'title_tokens.sqlite'
+)
+
+_TOKENS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tokens (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (kind, key)
+)
+'''
+
+# Memoizes tokenization results by (kind, key), e.g. ("word", "FlagOf"). Up to
+# @max_size most recently used results are kept in memory. If @path is
+# specified, all of them are also saved into a SQLite database there, so that
+# next runs and other processes reuse them. Results from the database are only
+# read if @read_persistent, otherwise they are recomputed and overwritten
+class _TokenCache:
+    def __init__(self, path: Optional[str], max_size: int, read_persistent: bool):
+        self.max_size = max_size
+        self.read_persistent = read_persistent
+        self._memory: OrderedDict = OrderedDict()
+        self._pending: List[Tuple[str, str, str]] = []
+        self._conn = None
+        if path:
+            os.makedirs(dirname(path), exist_ok=True)
+            self._conn = sqlite3.connect(path, timeout=30)
+            self._conn.execute(_TOKENS_SCHEMA)
+
+    def _remember(self, kind: str, key: str, value: str) -> None:
+        self._memory[(kind, key)] = value
+        self._memory.move_to_end((kind, key))
+        if len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def get(self, kind: str, key: str) -> Optional[str]:
+        if (kind, key) in self._memory:
+            self._memory.move_to_end((kind, key))
+            return self._memory[(kind, key)]
+        
+        if self._conn is None or not self.read_persistent:
+            return None
+        
+        row = self._conn.execute(
+            'SELECT value FROM tokens WHERE kind = ? AND key = ?', (kind, key)
+        ).fetchone()
+        if row is None:
+            return None
+        
+        self._remember(kind, key, row[0])
+        return row[0]
+
+    def put(self, kind: str, key: str, value: str) -> None:
+        self._remember(kind, key, value)
+        if self._conn is not None:
+            self._pending.append((kind, key, value))
+
+    # saves results put since the last call into the database
+    def flush(self) -> None:
+        if self._conn is None or len(self._pending) == 0:
+            return
+        
+        with self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO tokens VALUES (?, ?, ?)', self._pending
+            )
+        self._pending = []
+
+# Fills @parsed_title field of image metadata with image title split into words.
+# The same titles and words occur in many articles, so both whole titles and
+# splits of single words are memoized, see _TokenCache. Up to @cache_size of
+# them are kept in memory, and if @persistent_cache is True, all of them are
+# saved into SQLite database @cache_path to be reused by next runs. It should
+# be on a local disk, by default it's in ~/.cache/pywikimm
+class TitleTokensStage(IStage):
+    def __init__(
+        self,
+        invalidate_cache: bool = False,
+        cache_size: int = 100000,
+        persistent_cache: bool = True,
+        cache_path: str = _DEFAULT_TOKENS_CACHE_PATH,
+    ):
+        self.invalidate_cache = invalidate_cache
+        self.cache_size = cache_size
+        self.persistent_cache = persistent_cache
+        self.cache_path = cache_path
+        self.tokenizer = None
+        self.cache = None
+        self.mapper = str.maketrans({x: '' for x in string.punctuation})
+        self.regex = re.compile(r'(\d+)')
+
+    # tokenizer and cache are created again in every process the stage is
+    # sent to
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state['tokenizer'] = None
+        state['cache'] = None
+        return state
+
+    def _tokenize_word(self, word: str) -> str:
+        if word.isdigit():
+            return word
+        
+        res = self.cache.get('word', word)
+        if res is None:
+            if self.tokenizer is None:
+                self.tokenizer = CrazyTokenizer(hashtags='split')
+            res = " ".join(self.tokenizer.tokenize("#" + word))
+            self.cache.put('word', word, res)
+        return res
+
+    def _tokenize_title(self, title: str) -> str:
+        res = self.cache.get('title', title)
+        if res is None:
+            filename = os.path.splitext(title)[0]
+            sentence = filename.translate(self.mapper)
+            sentence = self.regex.sub(r' \g<1> ', sentence)
+            
+            words = [self._tokenize_word(x) for x in sentence.split()]
+            res = " ".join(x for x in words if x != "")
+            self.cache.put('title', title, res)
+        return res
+
+    def apply(
+        self, article_path: str, meta_arr: List[JSONType]
+    ) -> List[JSONType]:
+        if self.cache is None:
+            self.cache = _TokenCache(
+                path=self.cache_path if self.persistent_cache else None,
+                max_size=self.cache_size,
+                read_persistent=not self.invalidate_cache,
+            )
+
+        for meta in meta_arr:
+            if 'parsed_title' in meta and not self.invalidate_cache:
+                continue
+            
+            meta['parsed_title'] = self._tokenize_title(meta['title'])
+
+        self.cache.flush()
+        return meta_arr
+
+# stages of the pipeline run by the current worker process, see _init_worker
+_WORKER_STAGES: Sequence[IStage] = []
+
+def _init_worker(stages: Sequence[IStage]) -> None:
+    global _WORKER_STAGES
+    _WORKER_STAGES = stages
+
+# Returns True if meta.json of the article was changed
+def _process_article(path: str, stages: Sequence[IStage]) -> bool:
+    meta_path = join(path, 'img/', 'meta.json')
+    meta = _getJSON(meta_path)
+    for stage in stages:
+        meta['img_meta'] = stage.apply(path, meta['img_meta'])
+        
+    return _dump_if_changed(meta_path, meta)
+
+# Runs in a worker process. Errors are returned instead of raised, so that the
+# parent can record them and go on with other articles
+def _process_article_in_worker(
+    task: Tuple[int, str]
+) -> Tuple[int, str, bool, Optional[str]]:
+    i, path = task
+    try:
+        return (i, path, _process_article(path, _WORKER_STAGES), None)
+    except Exception as e:
+        return (i, path, False, str(e))
+
+# Applies all @stages in the given order to image metadata of every article
+# in @data_path. Each meta.json is read once and written once, no matter how
+# many stages there are. If @state_db is specified, progress is recorded in that
+# SQLite database, see state.CrawlState. Then articles which already completed
+# all @stages are skipped, unless some stage invalidates its cache, and articles
+# which fail are recorded and skipped instead of stopping the pipeline.
+# If @workers > 1, articles are distributed between that many processes. Each
+# of them gets its own copy of @stages, so expensive state, such as ResNet152
+# model or tokenizer, is created once per process. Stages must be picklable
+# then, e.g. FilterStage predicates have to be module-level functions.
+# meta.json of an article is only written if some stage changed it. Returns
+# number of such articles
+def run_pipeline(
     data_path: str,
+    stages: Sequence[IStage],
     offset: int = 0,
     limit: int = None,
-    mapper: IMapper = None,
-    invalidate_cache: bool = False,
     debug_info: bool = False,
-) -> None:
-    article_paths = [
-        join(data_path, f) 
-        for f in listdir(data_path) if isdir(join(data_path, f))
-    ]
-    
+    state_db: Optional[str] = None,
+    workers: int = 1,
+) -> int:
+    article_paths = _get_article_paths(data_path)
     valid_limit = _validated_limit(limit, offset, len(article_paths))
-    mapper = mapper if mapper else ResNet152Mapper() 
     
+    state = CrawlState(state_db) if state_db else None
+    refresh = any(getattr(x, 'invalidate_cache', False) for x in stages)
+    done = (
+        set.intersection(*[state.done_articles(x.name()) for x in stages])
+        if state and len(stages) > 0 and not refresh
+        else set()
+    )
+    
+    tasks = []
     for i in range(offset, offset + valid_limit):
         path = article_paths[i]
-        if debug_info: print(i, path)
+        if basename(path) in done:
+            if debug_info: print(i, 'Skipping completed', path)
+            continue
+        tasks.append((i, path))
+        
+    def record(path: str, error: Optional[str]) -> None:
+        article = basename(path)
+        if error is not None:
+            print("ERROR: failed to preprocess", path, '|||', error)
+            for stage in stages:
+                state.set_article_status(article, stage.name(), STATUS_FAILED, error)
+        elif state:
+            for stage in stages:
+                state.set_article_status(article, stage.name(), STATUS_DONE)
     
-        meta_path = join(path, 'img/', 'meta.json')
-        meta_arr = _getJSON(meta_path)['img_meta']
-        for meta in meta_arr:
-            if 'features' in meta and not invalidate_cache: 
-                continue
-                
-            img_path =  join(path, 'img/', meta['filename'])
-            try:
-                meta['features'] = mapper.map(img_path)
-            except Exception as e:
-                print("ERROR: exception for image", img_path, '|||', str(e))
-                continue
-                
-        _dump(meta_path, {"img_meta": meta_arr})
+    updated = 0
+    try:
+        if workers <= 1:
+            for i, path in tasks:
+                if debug_info: print(i, path)
+                try:
+                    updated += _process_article(path, stages)
+                except Exception as e:
+                    if state is None:
+                        raise
+                    record(path, str(e))
+                    continue
+                record(path, None)
+        else:
+            with multiprocessing.Pool(workers, _init_worker, (stages,)) as pool:
+                results = pool.imap_unordered(_process_article_in_worker, tasks)
+                for i, path, changed, error in results:
+                    if debug_info: print(i, path)
+                    if error is not None and state is None:
+                        raise Exception('Failed to preprocess {}: {}'.format(path, error))
+                    record(path, error)
+                    updated += changed
+    finally:
+        if state:
+            state.close()
+            
+    print('Updated {} of {} articles'.format(updated, len(tasks)))
+    return updated
+
+def generate_visual_features(
+    data_path: str,
+    offset: int = 0,
+    limit: int = None,
+    mapper: IMapper = None,
+    invalidate_cache: bool = False,
+    debug_info: bool = False,
+    store: str = 'npy',
+    state_db: Optional[str] = None,
+    workers: int = 1,
+) -> int:
+    return run_pipeline(
+        data_path=data_path,
+        stages=[VisualFeaturesStage(mapper, invalidate_cache, store)],
+        offset=offset,
+        limit=limit,
+        debug_info=debug_info,
+        state_db=state_db,
+        workers=workers,
+    )
         
 def filter_img_metadata(
     data_path: str,
@@ -212,26 +753,18 @@ def filter_img_metadata(
     offset: int = 0,
     limit: int = None,
     debug_info: bool = False,
-) -> None:
-    article_paths = [
-        join(data_path, f)
-        for f in listdir(data_path) if isdir(join(data_path, f))
-    ]
-
-    valid_limit = _validated_limit(limit, offset, len(article_paths))
-    for i in range(offset, offset + valid_limit):
-        path = article_paths[i]
-        if debug_info: print(i, path)
-    
-        meta_path = join(path, 'img/', 'meta.json')
-        meta_arr = _getJSON(meta_path)['img_meta']
-        
-        meta_arr_filtered = [x for x in meta_arr if predicate(x)]
-        for x in meta_arr_filtered:
-            # useless fields since now it always the same
-            x.pop(field_to_remove, None)
-                
-        _dump(meta_path, {"img_meta": meta_arr_filtered})
+    state_db: Optional[str] = None,
+    workers: int = 1,
+) -> int:
+    return run_pipeline(
+        data_path=data_path,
+        stages=[FilterStage(predicate, field_to_remove)],
+        offset=offset,
+        limit=limit,
+        debug_info=debug_info,
+        state_db=state_db,
+        workers=workers,
+    )
 
 def tokenize_image_titles(
     data_path: str,
@@ -239,42 +772,18 @@ def tokenize_image_titles(
     limit: int = None,
     invalidate_cache: bool = False,
     debug_info: bool = False,
-) -> None:
-    article_paths = [
-        join(data_path, f) 
-        for f in listdir(data_path) if isdir(join(data_path, f))
-    ]
-    
-    valid_limit = _validated_limit(limit, offset, len(article_paths))
-    tokenizer = CrazyTokenizer(hashtags='split')
-    mapper = str.maketrans({x: '' for x in string.punctuation})
-    regex = re.compile(r'(\d+)')
-
-    for i in range(offset, offset + valid_limit):
-        path = article_paths[i]
-        if debug_info: print(i, path)
-    
-        meta_path = join(path, 'img/', 'meta.json')
-        meta_arr = _getJSON(meta_path)['img_meta']
-        for meta in meta_arr:
-            if 'parsed_title' in meta and not invalidate_cache:
-                continue
-                
-            filename = os.path.splitext(meta['title'])[0]
-            sentence = filename.translate(mapper)
-            sentence = regex.sub(r' \g<1> ', sentence)
-
-            tokens = []
-            for word in sentence.split():
-                tokens += (
-                    tokenizer.tokenize("#" + word) 
-                    if not word.isdigit() 
-                    else [word]
-                )
-            
-            meta['parsed_title'] = " ".join(tokens)
-                
-        _dump(meta_path, {"img_meta": meta_arr})
+    state_db: Optional[str] = None,
+    workers: int = 1,
+) -> int:
+    return run_pipeline(
+        data_path=data_path,
+        stages=[TitleTokensStage(invalidate_cache)],
+        offset=offset,
+        limit=limit,
+        debug_info=debug_info,
+        state_db=state_db,
+        workers=workers,
+    )
 
 
 # Parses image headings from the article. That is, updates @headings field of
@@ -286,15 +795,34 @@ def parse_image_headings(
     invalidate_cache: bool = False,
     debug_info: bool = False,
     language_code: str = 'en',
-) -> None:
-    article_paths = [
-        join(data_path, f) 
-        for f in listdir(data_path) if isdir(join(data_path, f))
-    ]
-    
-    valid_limit = _validated_limit(limit, offset, len(article_paths))
-    for i in range(offset, offset + valid_limit):
-        path = article_paths[i]
-        if debug_info: print(i, path)
+    state_db: Optional[str] = None,
+    workers: int = 1,
+) -> int:
+    return run_pipeline(
+        data_path=data_path,
+        stages=[HeadingsStage(invalidate_cache, language_code)],
+        offset=offset,
+        limit=limit,
+        debug_info=debug_info,
+        state_db=state_db,
+        workers=workers,
+    )
+
+# Returns visual features of every image of the article in @article_path as a
+# dict from image filename to its feature vector. Vectors stored in
+# features.npy are views of a single memory-mapped matrix, so nothing is
+# copied or parsed. Images whose row doesn't match its checksum, e.g. after
+# an interrupted preprocessing, are left out until they are mapped again
+def load_visual_features(article_path: str) -> Dict[str, np.ndarray]:
+    meta_arr = _getJSON(join(article_path, 'img', 'meta.json'))['img_meta']
+    store_path = join(article_path, 'img', _FEATURES_FILE)
+    stored = np.load(store_path, mmap_mode='r') if exists(store_path) else None
     
-        _parse_img_headings(path, invalidate_cache, language_code)
+    res = {}
+    for meta in meta_arr:
+        if _is_valid_row(meta, stored):
+            res[meta['filename']] = stored[meta['features_row']]
+        elif 'features' in meta:
+            res[meta['filename']] = np.array(meta['features'], dtype='float32')
+            
+    return res
@@ -2,36 +2,65 @@
 import pywikibot
 import json
 import hashlib
+import itertools
+import os
 import urllib
 import re
 import shutil
+import threading
 import time
-import urllib.request
 
 from pathlib import Path
-from pywikibot import pagegenerators, Page
-from pywikibot.data.api import PageGenerator
-from urllib.request import urlretrieve
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pywikibot import Page, config
+from pywikibot.data.api import PageGenerator, Request, update_page
 from html.parser import HTMLParser
 from html.entities import name2codepoint
 from os import listdir, stat
 from os.path import isfile, join, basename
-from dataclasses import dataclass
+from dataclasses import dataclass, replace, asdict
+from abc import ABC, abstractmethod
 from typing import Optional
 from selenium import webdriver
 from selenium.webdriver.firefox.options import Options
 from selenium.webdriver.firefox.webdriver import WebDriver
+from selenium.common.exceptions import (
+    WebDriverException,
+    NoSuchElementException,
+    StaleElementReferenceException,
+)
+from contextlib import contextmanager
 from urllib.parse import unquote
 from bs4 import BeautifulSoup
-from typing import Set, Optional, List, Tuple
+from bs4.element import Tag
+from typing import Set, Optional, List, Tuple, Dict, Iterator
+from pywikimm.network import (
+    _download,
+    _fetch_text,
+    _throttle,
+    _is_throttled,
+    _configure_rate_limit,
+    _configure_http_cache,
+)
+from pywikimm.state import CrawlState, STATUS_DONE, STATUS_FAILED
 from pywikimm.utils import (
     _getJSON,
     _dump,
+    _dump_if_changed,
+    _remove_damaged_files,
+    _get_shared_path,
+    _get_tmp_path,
     _get_translated_file_label,
     _valid_img_type,
-    _validated_limit,
+    _get_img_index,
+    _in_shard,
+    _get_known_icons_shard_path,
+    _update_known_icons,
     _KNOWN_ICONS_PATH,
     _KNOWN_ICONS,
+    _FEATURES_FILE,
+    JSONType,
 )
 
 # TODO: replace with beautifulsoup
@@ -59,6 +88,117 @@ class _MyHTMLParser(HTMLParser):
     def get_description(self):
         return self._description
 
+# names of stages recorded in CrawlState
+_QUERY_STAGE = 'query'
+_IMG_STAGE = 'img_download'
+
+# outcomes of querying an article: some of its files were written, everything
+# was already up to date, the page doesn't exist or the article was skipped,
+# e.g. because it's not cached and QueryParams.only_update_cached_pages is set
+_ARTICLE_UPDATED = 'updated'
+_ARTICLE_UNCHANGED = 'unchanged'
+_ARTICLE_MISSING = 'missing'
+_ARTICLE_SKIPPED = 'skipped'
+
+# API limit of titles per request for regular users
+_API_BATCH_SIZE = 50
+
+# Set of image names collected during a query, e.g. discovered icons. Shared
+# between articles which are processed concurrently, so every access is
+# guarded by a lock
+class _NameSet:
+    def __init__(self):
+        self._names: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def __contains__(self, name: str) -> bool:
+        with self._lock:
+            return name in self._names
+
+    def add(self, name: str) -> None:
+        with self._lock:
+            self._names.add(name)
+
+    # adds @name and returns True if it wasn't in the set before
+    def add_new(self, name: str) -> bool:
+        with self._lock:
+            if name in self._names:
+                return False
+            self._names.add(name)
+            return True
+
+    def to_set(self) -> Set[str]:
+        with self._lock:
+            return set(self._names)
+
+# Reads article titles from @filename the same way as TextfilePageGenerator,
+# but lazily and without creating pages. That is, if the file contains
+# [[wiki links]], yields their targets, otherwise every non-empty line is a
+# title. Since the file is not read up front, the format is decided by its
+# first non-empty line
+def _read_titles(filename: str) -> Iterator[str]:
+    with open(filename, encoding=config.textfile_encoding) as f:
+        links_only = None
+        for line in f:
+            if links_only is None and line.strip():
+                links_only = pywikibot.link_regex.search(line) is not None
+                
+            if links_only:
+                for linkmatch in pywikibot.link_regex.finditer(line):
+                    yield linkmatch.group('title')
+            else:
+                title = line.strip()
+                if '|' in title:
+                    title = title[:title.index('|')]
+                if title:
+                    yield title
+
+def _chunks(iterable: Iterator, size: int) -> Iterator[List]:
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+# Lazily yields (index, page, latest revision id) of articles from @filename
+# which belong to the shard of @params, starting from @params.offset and
+# at most @params.limit of them. Titles are read and page info is loaded in
+# batches as they are consumed, so memory and time to the first article don't
+# depend on the size of the input file. Page content is still only loaded if
+# text.json is downloaded
+def _stream_pages(
+    filename: str, site: pywikibot.Site, params: "QueryParams"
+) -> Iterator[Tuple[int, Page, Optional[int]]]:
+    titles = (
+        title for title in _read_titles(filename)
+        if _in_shard(title, params.shard_id, params.num_shards)
+    )
+    stop = params.offset + params.limit if params.limit else None
+    titles = itertools.islice(titles, params.offset, stop)
+    
+    i = params.offset
+    for batch in _chunks(titles, _API_BATCH_SIZE):
+        pages = [Page(site, title) for title in batch]
+        revids = _query_latest_revids(pages)
+        for p in pages:
+            yield (i, p, revids.get(p.title()))
+            i += 1
+
+# Same as executor.map, but submits at most @max_pending tasks ahead instead
+# of consuming the whole @iterable at once. Results are yielded in order
+def _bounded_map(
+    executor: ThreadPoolExecutor, fn, iterable: Iterator, max_pending: int
+) -> Iterator:
+    pending = deque()
+    for x in iterable:
+        pending.append(executor.submit(fn, x))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+            
+    while pending:
+        yield pending.popleft().result()
+
 def _get_path(out_dir: Path, create_if_not_exists: bool) -> Path:
     requests_path = Path(out_dir)
     if not requests_path.exists() and create_if_not_exists:
@@ -66,6 +206,9 @@ def _get_path(out_dir: Path, create_if_not_exists: bool) -> Path:
       
     return requests_path
 
+def _get_page_dir(p: Page, params: "QueryParams") -> Path:
+    return Path(params.out_dir + p.title(as_filename=True).rstrip('.'))
+
 def _get_url(img_name: str, size: int = 600) -> str:
     # TODO: img.oldest_file_info.url might have the same information
     url_prefix = "https://upload.wikimedia.org/wikipedia/commons/thumb/"
@@ -84,6 +227,107 @@ def _get_description(img: Page) -> str:
     parser.feed(img.getImagePageHtml())
     return parser.get_description().replace("\n", "")
 
+@dataclass
+class _ImgInfo:
+    # canonical url of the thumbnail with the requested width
+    thumb_url: Optional[str]
+    # width of the thumbnail. For files narrower than requested, the API
+    # returns the original file and its width instead
+    thumb_width: Optional[int]
+    # True if the file is hosted on Wikimedia Commons
+    on_commons: bool
+    description: str
+
+# Queries ids of the latest revisions of at most _API_BATCH_SIZE @pages with a
+# single API request. Returns a dict from page title to its revision id.
+# Missing pages are omitted. The same reply also fills pageid and other info
+# of @pages, so that they don't need a request per page later
+def _query_latest_revids(pages: List[Page]) -> Dict[str, int]:
+    res = {}
+    if len(pages) == 0:
+        return res
+    
+    by_title = {p.title(): p for p in pages}
+    request = Request(site=pages[0].site, parameters={
+        'action': 'query',
+        'prop': 'info',
+        'titles': list(by_title),
+    })
+    
+    for page in request.submit().get('query', {}).get('pages', {}).values():
+        if page.get('title') in by_title:
+            update_page(by_title[page['title']], page, props=['info'])
+        if 'lastrevid' in page:
+            res[page['title']] = page['lastrevid']
+            
+    return res
+
+def _with_revid(data: JSONType, revid: Optional[int]) -> JSONType:
+    if revid is not None:
+        data['lastrevid'] = revid
+    return data
+
+# Records in meta.json at @meta_path that the article is stored for revision
+# @revid. Must be the last write of the article, see _is_up_to_date
+def _stamp_revid(meta_path: Path, revid: int) -> None:
+    if not meta_path.exists():
+        return
+    meta = _getJSON(meta_path)
+    if meta.get('lastrevid') != revid:
+        _dump(meta_path, _with_revid(meta, revid))
+
+# Returns True if both text.json and meta.json of the article were downloaded
+# for revision @revid. Only meta.json is parsed, since text.json with the whole
+# article is much larger. That's enough, because lastrevid of meta.json is
+# updated only after text, images and captions of the article are all stored
+def _is_up_to_date(page_dir: Path, revid: int) -> bool:
+    try:
+        if stat(page_dir / 'text.json').st_size == 0:
+            return False
+        return _getJSON(page_dir / 'img' / 'meta.json').get('lastrevid') == revid
+    except (OSError, ValueError, UnicodeDecodeError):
+        return False
+
+# Queries imageinfo for all @imgs with one API request per _API_BATCH_SIZE
+# files instead of fetching an image description page per file. Returns a dict
+# from image title (with namespace) to its info. Images missing in the
+# response are omitted
+def _query_img_info(
+    imgs: List[Page], params: "QueryParams"
+) -> Dict[str, _ImgInfo]:
+    res = {}
+    for k in range(0, len(imgs), _API_BATCH_SIZE):
+        batch = imgs[k:k + _API_BATCH_SIZE]
+        request = Request(site=batch[0].site, parameters={
+            'action': 'query',
+            'prop': 'imageinfo',
+            'titles': [img.title() for img in batch],
+            'iiprop': 'url|extmetadata',
+            'iiurlwidth': params.img_width,
+            'iiextmetadatafilter': 'ImageDescription',
+        })
+        
+        pages = request.submit().get('query', {}).get('pages', {})
+        for page in pages.values():
+            if 'imageinfo' not in page:
+                continue
+            
+            info = page['imageinfo'][0]
+            description_html = (
+                info.get('extmetadata', {})
+                    .get('ImageDescription', {})
+                    .get('value', '')
+            )
+            description = BeautifulSoup(description_html, 'html.parser').text
+            res[page['title']] = _ImgInfo(
+                thumb_url=info.get('thumburl'),
+                thumb_width=info.get('thumbwidth'),
+                on_commons=(page.get('imagerepository') == 'shared'),
+                description=description.replace("\n", ""),
+            )
+            
+    return res
+
 def _get_img_path(img: Page, img_dir: Path) -> Tuple[str, Path, Path]:
     img_name = unquote(img.title(with_ns=False, as_url=True))
     img_name_valid = hashlib.md5(img_name.encode('utf-8')).hexdigest()  
@@ -92,11 +336,43 @@ def _get_img_path(img: Page, img_dir: Path) -> Tuple[str, Path, Path]:
         
     return img_name, img_path, img_path_orig
 
+# Image linked from an article with everything needed to maintain its cache and
+# download it. Computed once per article, since every iteration over
+# imagelinks of a page may repeat the API query
+@dataclass
+class _ArticleImg:
+    page: Page
+    title: str  # without namespace, as in meta.json
+    name: str  # as in urls, e.g. with "_" instead of spaces
+    path: Path
+    path_orig: Path
+    valid: bool
+
+def _get_article_imgs(
+    img_links: PageGenerator, img_dir: Path, params: "QueryParams"
+) -> List[_ArticleImg]:
+    res = []
+    for img in img_links:
+        img_name, img_path, img_path_orig = _get_img_path(img, img_dir)
+        res.append(_ArticleImg(
+            page=img,
+            title=img.title(with_ns=False),
+            name=img_name,
+            path=img_path,
+            path_orig=img_path_orig,
+            valid=_valid_img_type(img_name, params.early_icons_removal),
+        ))
+    return res
+
 def _single_img_download(
-    img: Page, img_dir: Path, params: "QueryParams"
+    img: _ArticleImg,
+    img_dir: Path,
+    params: "QueryParams",
+    info: Optional[_ImgInfo],
+    refreshed_imgs: Optional[_NameSet] = None,
 ) -> Tuple[bool, str]:
-    img_name, img_path, img_path_orig = _get_img_path(img, img_dir)
-    if not _valid_img_type(img_name, params.early_icons_removal):
+    img_name, img_path, img_path_orig = img.name, img.path, img.path_orig
+    if not img.valid:
         if img_path.exists():
             img_path.unlink()
                 
@@ -108,14 +384,76 @@ def _single_img_download(
     if img_path_orig.exists():
         return (False, img_path_orig.name)
     
+    if not params.shared_img_store:
+        path = _fetch_img(img.page, img_name, img_path, img_path_orig, params, info)
+        return (True, path.name)
+    
+    shared_path = _get_shared_path(params.out_dir, 'img', img_path.name)
+    shared_path_orig = shared_path.parent / img_path_orig.name
+    # on invalidation, an image used by many articles is still downloaded
+    # once per query, the first article to get it records it in @refreshed_imgs
+    refresh = params.invalidate_cache.img_cache and (
+        refreshed_imgs is None or refreshed_imgs.add_new(img_path.name)
+    )
+    downloaded = False
+    if refresh or (not shared_path.exists() and not shared_path_orig.exists()):
+        shared_path.parent.mkdir(parents=True, exist_ok=True)
+        _fetch_img(img.page, img_name, shared_path, shared_path_orig, params, info)
+        downloaded = True
+    elif params.debug_info:
+        print('Reusing image', img_name)
+        
+    src = shared_path if shared_path.exists() else shared_path_orig
+    _link(src, img_dir / src.name)
+    return (downloaded, src.name)
+
+# Downloads a thumbnail of @img into @img_path. If it's unavailable from
+# commons, downloads the original image into @img_path_orig instead. Returns
+# the path of the downloaded file
+def _fetch_img(
+    img: Page,
+    img_name: str,
+    img_path: Path,
+    img_path_orig: Path,
+    params: "QueryParams",
+    info: Optional[_ImgInfo],
+) -> Path:
     if params.debug_info: print('Downloading image', img_name)
     try:
-        urlretrieve(_get_url(img_name, params.img_width), img_path)
-        return (True, img_path.name) 
+        if info and not info.on_commons:
+            raise Exception('{} is not available on commons'.format(img_name))
+        
+        # the original of a narrower file isn't a jpeg of @img_width, so it's
+        # requested with _get_url as well and saved as .ORIGINAL when that fails
+        url = (
+            info.thumb_url
+            if info and info.thumb_url and info.thumb_width == params.img_width
+            else _get_url(img_name, params.img_width)
+        )
+        _download(url, img_path, params.max_connections_per_host)
+        return img_path
     except Exception as e:
+        if _is_throttled(e):
+            # original is even more expensive, so don't make things worse
+            raise
+        
         print(str(e))
-        img.download(filename=img_path_orig, chunk_size=8*1024)
-        return (True, img_path_orig.name)
+        tmp_path = _get_tmp_path(img_path_orig)
+        img.download(filename=tmp_path, chunk_size=8*1024)
+        os.replace(tmp_path, img_path_orig)
+        return img_path_orig
+
+# Makes @src available at @dst without copying, if file system allows that
+def _link(src: Path, dst: Path) -> None:
+    if dst.exists():
+        dst.unlink()
+    
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        pass  # another thread linked the same image in the meantime
+    except OSError:
+        shutil.copyfile(src, dst)
 
 def _remove_invalid_imgs(img_dir: Path) -> None:
     files = [img_dir/f for f in listdir(img_dir) if isfile(join(img_dir, f))]
@@ -124,35 +462,39 @@ def _remove_invalid_imgs(img_dir: Path) -> None:
             print("Removing corrupted image", fpath)
             fpath.unlink()
     
-def _remove_obsolete_imgs(
-    img_dir: Path, img_links: PageGenerator, params: "QueryParams"
-) -> None:
-    uptodate_imgs = [_get_img_path(img, img_dir) for img in img_links]
-    icon_removal = params.early_icons_removal
+# Returns True if any image or metadata was removed
+def _remove_obsolete_imgs(img_dir: Path, imgs: List[_ArticleImg]) -> bool:
     img_names = (
-        [x[1].name for x in uptodate_imgs if _valid_img_type(x[0], icon_removal)] +
-        [x[2].name for x in uptodate_imgs if _valid_img_type(x[0], icon_removal)]
+        {x.path.name for x in imgs if x.valid} |
+        {x.path_orig.name for x in imgs if x.valid}
     )
     
+    res = False
     files = [img_dir/f for f in listdir(img_dir) if isfile(join(img_dir, f))]
     for fpath in files:
         fname = fpath.name
-        if (fname not in img_names) and fname[-5:].lower() != ".json":
+        is_data = fname[-5:].lower() == ".json" or fname == _FEATURES_FILE
+        if (fname not in img_names) and not is_data:
             print("Removing obsolete image", fpath)
             fpath.unlink()
+            res = True
     
     meta_path = img_dir/'meta.json'
     if not meta_path.exists():
-        return
+        return res
     
     meta = _getJSON(meta_path)
     uptodate_meta = [x for x in meta['img_meta'] if x['filename'] in img_names]
     if len(meta['img_meta']) != len(uptodate_meta):
         print("META", img_dir)
-        _dump(meta_path, {"img_meta": uptodate_meta})
+        meta['img_meta'] = uptodate_meta
+        _dump(meta_path, meta)
+        res = True
+        
+    return res
         
 def _is_meta_outdated(
-    meta_path: Path, img_links: PageGenerator, params: "QueryParams"
+    meta_path: Path, imgs: List[_ArticleImg], params: "QueryParams"
 ) -> bool:
     if not meta_path.exists():
         return True
@@ -162,63 +504,111 @@ def _is_meta_outdated(
     
     meta = _getJSON(meta_path)['img_meta']
     meta_titles = [x['title'] for x in meta]
-    current_titles = [
-        x.title(with_ns=False)
-        for x in img_links
-        if _valid_img_type(x.title(with_ns=False), params.early_icons_removal)
-    ]
+    current_titles = [x.title for x in imgs if x.valid]
     
     res = sorted(meta_titles) != sorted(current_titles)
     if res and params.debug_info: print("OUTDATED META", meta_path)
     return res
     
 
+# Downloads images of the article in @page_dir and their metadata. Returns the
+# number of downloaded images, the number of those unavailable from commons,
+# and whether any image or metadata of the article was changed
 def _img_download(
     img_links: PageGenerator,
     page_dir: Path,
     params: "QueryParams",
     tc: int,
-    uc: int
-) -> Tuple[int, int]:
+    uc: int,
+    state: Optional[CrawlState] = None,
+    refreshed_imgs: Optional[_NameSet] = None,
+) -> Tuple[int, int, bool]:
+    updated = params.invalidate_cache.img_cache
     if params.invalidate_cache.img_cache:
         shutil.rmtree(page_dir/"img", ignore_errors=True)
         
     img_dir = _get_path(page_dir/"img", create_if_not_exists=True)
     meta_path = img_dir / 'meta.json'
 
+    imgs = _get_article_imgs(img_links, img_dir, params)
+
     _remove_invalid_imgs(img_dir)
     if params.invalidate_cache.img_meta_cache or params.invalidate_cache.oudated_img_meta_cache:
-        _remove_obsolete_imgs(img_dir, img_links, params)
+        updated = _remove_obsolete_imgs(img_dir, imgs) or updated
     
     download_meta = (
         params.invalidate_cache.img_meta_cache or
-        _is_meta_outdated(meta_path, img_links, params)
+        _is_meta_outdated(meta_path, imgs, params)
     )
 
     if download_meta and params.debug_info: print("Updating image metadata")
+    is_missing = lambda img: (
+        img.valid and not img.path.exists() and not img.path_orig.exists()
+    )
+    
+    infos = {}
+    if params.batch_img_metadata and len(imgs) > 0 and (
+        download_meta or any(is_missing(img) for img in imgs)
+    ):
+        infos = _query_img_info([img.page for img in imgs], params)
+        
+    def download(img: _ArticleImg) -> Tuple[bool, str]:
+        try:
+            res = _single_img_download(
+                img, img_dir, params, infos.get(img.page.title()), refreshed_imgs
+            )
+        except Exception as e:
+            if state:
+                state.set_image_status(
+                    page_dir.name, img.title, _IMG_STAGE,
+                    STATUS_FAILED, str(e),
+                )
+            if _is_throttled(e):
+                # still throttled after all retries. Skipping the image rather
+                # than stopping the whole query, it's downloaded on the next run
+                print('Skipping throttled image', img.name, '|||', str(e))
+                return (False, "")
+            raise
+            
+        if state and res[1] != "":
+            state.set_image_status(
+                page_dir.name, img.title, _IMG_STAGE, STATUS_DONE
+            )
+        return res
+        
+    with ThreadPoolExecutor(max_workers=params.img_download_workers) as executor:
+        results = list(executor.map(download, imgs))
+
     meta = []
-    for img in img_links:
-        downloaded, filename = _single_img_download(img, img_dir, params)
+    for img, (downloaded, filename) in zip(imgs, results):
         if downloaded: 
             tc += 1
             
         if download_meta and filename != "":
             meta.append({
                 "filename": filename,
-                "title": img.title(with_ns=False),
-                "url": img.full_url(),
+                "title": img.title,
+                "url": img.page.full_url(),
                 'on_commons': not filename.endswith('.ORIGINAL'),
             })
 
             if params.fill_property.img_description:
-                description = _get_description(img)
+                description = (
+                    infos[img.page.title()].description
+                    if img.page.title() in infos
+                    else _get_description(img.page)
+                )
                 if len(description) > 0:
                     meta[-1]['description'] = description
           
     if download_meta:
-        _dump(meta_path, {"img_meta": meta})
+        meta_json = {"img_meta": meta}
+        if meta_path.exists():
+            # the revision stays the old one until _query_article is finished
+            _with_revid(meta_json, _getJSON(meta_path).get('lastrevid'))
+        updated = _dump_if_changed(meta_path, meta_json) or updated
     
-    return (tc, uc)
+    return (tc, uc, updated or tc > 0)
 
 def _remove_prefix(text: str, prefix: str) -> str:
     if text.startswith(prefix):
@@ -244,55 +634,279 @@ def _get_image_captions(
         res.append((filename, div.text))
     return res
 
+# Loads image preview and polls for its caption until it appears or @timeout
+# seconds pass. Delay between polls starts from @poll_interval and doubles up
+# to a second. Returns the caption, if any, and how long we waited for it
 def _parse_caption_with_js(
     driver: WebDriver,
     language_code: str,
     page_id: str,
     img_id: str,
-    icons: Set[str],
-    debug_info: bool
-) -> Optional[str]:
-    caption = None
-    if img_id in _KNOWN_ICONS or img_id in icons:
-        if debug_info: print('Skipping known icon', img_id)
-        return caption
-
+    debug_info: bool,
+    timeout: float = 5.0,
+    poll_interval: float = 0.1,
+) -> Tuple[Optional[str], float]:
     url = 'https://{}.wikipedia.org/wiki/{}#/media/{}{}'.format(
         language_code, page_id, _get_translated_file_label(language_code), img_id
     )
     if debug_info: print('Downloading captions for', url)
+    _throttle(url)
     driver.get(url)
 
-    sleep_time = 1
-    retry_count = 2
-    time.sleep(sleep_time) # reqired for JS to load content
-    for k in range(retry_count):
+    start = time.monotonic()
+    max_poll_interval = 1.0
+    while True:
         try:
             # TODO: there is a bug when trying to parse noviewer thum. Driver returns caption from previous page
             # Currently not reproducible when invalidate_cache=False and caption already exists
             caption = driver.find_element_by_class_name("mw-mmv-title").text
-            if caption == "":
-                caption = None
-                raise Exception
-            else:
-                break
+        except (NoSuchElementException, StaleElementReferenceException):
+            caption = ""
+            
+        wait_time = time.monotonic() - start
+        if caption != "" or wait_time >= timeout:
+            break
+            
+        time.sleep(min(poll_interval, timeout - wait_time))
+        poll_interval = min(2 * poll_interval, max_poll_interval)
+    
+    if debug_info: print('Waited {:.2f}s for caption of {}'.format(wait_time, img_id))
+    
+    # closing the tab so that we won't read it again if next page fails to load.
+    # Blank page is enough for that and doesn't require a network round trip
+    driver.get('about:blank')
+    return (caption if caption != "" else None, wait_time)
+
+# Source of preview captions, i.e. the ones shown by MultimediaViewer in the
+# "mw-mmv-title" element after clicking on an image in the article
+class _ICaptionBackend(ABC):
+    # returns a dict from each of @img_ids to its preview caption, or None if
+    # the image has no preview, which means it's an icon
+    @abstractmethod
+    def get_captions(
+        self, page_dir: Path, page_id: str, img_ids: List[str]
+    ) -> Dict[str, Optional[str]]:
+        ...
+
+    def print_stats(self) -> None:
+        pass
+
+# Reproduces MultimediaViewer captions from the article HTML without a browser.
+# Viewer opens for images linked to their file page, unless they are inside
+# excluded blocks such as "noviewer" or "metadata". Its title is the thumb or
+# gallery caption, otherwise the link title, otherwise the file name
+class _HtmlCaptionBackend(_ICaptionBackend):
+    _EXCLUDED_CLASSES = {'noviewer', 'metadata', 'noarticletext'}
+    
+    def __init__(self, language_code: str, max_connections_per_host: int):
+        self.language_code = language_code
+        self.max_connections_per_host = max_connections_per_host
+        
+    def _get_html(self, page_dir: Path) -> str:
+        text_json = _getJSON(page_dir / 'text.json')
+        if 'html' in text_json:
+            return text_json['html']
+        
+        return _fetch_text(text_json['url'], self.max_connections_per_host)
+    
+    @staticmethod
+    def _is_excluded(tag: Tag) -> bool:
+        for parent in [tag] + list(tag.parents):
+            classes = parent.get('class') or []
+            if _HtmlCaptionBackend._EXCLUDED_CLASSES.intersection(classes):
+                return True
+        return False
+    
+    @staticmethod
+    def _find_caption(link: Tag, img_id: str) -> str:
+        for container, caption_class in [
+            ('thumb', 'thumbcaption'), ('gallerybox', 'gallerytext')
+        ]:
+            parent = link.find_parent(class_=container)
+            caption = parent and parent.find(class_=caption_class)
+            if caption and caption.text.strip() != '':
+                return caption.text.strip()
+        
+        figure = link.find_parent('figure')
+        caption = figure and figure.find('figcaption')
+        if caption and caption.text.strip() != '':
+            return caption.text.strip()
+        
+        if link.get('title'):
+            return link.get('title')
+        
+        return Path(img_id).stem.replace('_', ' ')
+    
+    def get_captions(
+        self, page_dir: Path, page_id: str, img_ids: List[str]
+    ) -> Dict[str, Optional[str]]:
+        soup = BeautifulSoup(self._get_html(page_dir), 'html.parser')
+        prefix = '/wiki/' + _get_translated_file_label(self.language_code)
+        
+        captions = {}
+        for link in soup.findAll('a', href=True):
+            href = unquote(link.get('href'))
+            if not href.startswith(prefix) or not link.find('img'):
+                continue
+                
+            img_id = href[len(prefix):]
+            if img_id in captions or self._is_excluded(link.find('img')):
+                continue
+                
+            captions[img_id] = self._find_caption(link, img_id)
+            
+        return {img_id: captions.get(img_id) for img_id in img_ids}
+
+# Pool of up to @size headless browsers. Browsers are started lazily, i.e. only
+# when requested and there is no idle one. A browser that raised
+# WebDriverException is considered crashed, so it's closed and later replaced
+class _WebDriverPool:
+    def __init__(self, size: int):
+        self.size = size
+        self._idle: List[WebDriver] = []
+        self._started = 0
+        self._cond = threading.Condition()
+        
+    def _start(self) -> WebDriver:
+        options = Options()
+        options.headless = True
+        return webdriver.Firefox(options=options)
+    
+    def _take(self) -> WebDriver:
+        with self._cond:
+            while len(self._idle) == 0 and self._started >= self.size:
+                self._cond.wait()
+                
+            if len(self._idle) > 0:
+                return self._idle.pop()
+            self._started += 1
+            
+        try:
+            return self._start()
         except:
-            time.sleep(sleep_time) # reqired for JS to load content
-            print("RETRY", k, " ||| ", img_id)
+            with self._cond:
+                self._started -= 1
+                self._cond.notify()
+            raise
+            
+    def _discard(self, driver: WebDriver) -> None:
+        try:
+            driver.quit()
+        except Exception:
+            pass
+        
+        with self._cond:
+            self._started -= 1
+            self._cond.notify()
+    
+    @contextmanager
+    def acquire(self) -> Iterator[WebDriver]:
+        driver = self._take()
+        try:
+            yield driver
+        except WebDriverException:
+            print('WARNING: restarting crashed webdriver')
+            self._discard(driver)
+            raise
+        except:
+            self._give_back(driver)
+            raise
+        else:
+            self._give_back(driver)
+            
+    def _give_back(self, driver: WebDriver) -> None:
+        with self._cond:
+            self._idle.append(driver)
+            self._cond.notify()
+            
+    def close(self) -> None:
+        with self._cond:
+            drivers, self._idle = self._idle, []
+            
+        for driver in drivers:
+            driver.quit()
+
+# Loads preview of every image in a headless browser. Slow, but exactly matches
+# what users see. Previews are loaded concurrently by all browsers of @pool.
+# Time spent waiting for every caption is collected in @wait_times
+class _SeleniumCaptionBackend(_ICaptionBackend):
+    def __init__(self, pool: _WebDriverPool, params: "QueryParams"):
+        self.pool = pool
+        self.params = params
+        self.wait_times: List[float] = []
+        self._lock = threading.Lock()
+        
+    def _get_caption(self, page_id: str, img_id: str) -> Optional[str]:
+        retry_count = 2  # one more attempt on a fresh browser after a crash
+        for k in range(retry_count):
+            try:
+                with self.pool.acquire() as driver:
+                    caption, wait_time = _parse_caption_with_js(
+                        driver=driver,
+                        language_code=self.params.language_code,
+                        page_id=page_id,
+                        img_id=img_id,
+                        debug_info=self.params.debug_info,
+                        timeout=self.params.caption_wait_timeout,
+                        poll_interval=self.params.caption_poll_interval,
+                    )
+                    
+                with self._lock:
+                    self.wait_times.append(wait_time)
+                return caption
+            except WebDriverException:
+                if k == retry_count - 1:
+                    raise
+                    
+    def print_stats(self) -> None:
+        with self._lock:
+            if len(self.wait_times) == 0:
+                return
+            
+            print('Waited for {} captions: {:.2f}s on average, {:.2f}s at most'.format(
+                len(self.wait_times),
+                sum(self.wait_times) / len(self.wait_times),
+                max(self.wait_times),
+            ))
+        
+    def get_captions(
+        self, page_dir: Path, page_id: str, img_ids: List[str]
+    ) -> Dict[str, Optional[str]]:
+        with ThreadPoolExecutor(max_workers=self.pool.size) as executor:
+            captions = executor.map(
+                lambda img_id: self._get_caption(page_id, img_id), img_ids
+            )
+            return dict(zip(img_ids, captions))
+
+# Asks @fallback only for images which @primary reported as having no preview
+class _FallbackCaptionBackend(_ICaptionBackend):
+    def __init__(self, primary: _ICaptionBackend, fallback: _ICaptionBackend):
+        self.primary = primary
+        self.fallback = fallback
+        
+    def get_captions(
+        self, page_dir: Path, page_id: str, img_ids: List[str]
+    ) -> Dict[str, Optional[str]]:
+        res = self.primary.get_captions(page_dir, page_id, img_ids)
+        missing = [img_id for img_id in img_ids if res[img_id] is None]
+        if len(missing) > 0:
+            res.update(self.fallback.get_captions(page_dir, page_id, missing))
+            
+        return res
     
-    # closing the tab so that we won't read it again if next page fails to load
-    default_url = 'https://www.wikipedia.org/'
-    driver.get(default_url)
-    return caption
+    def print_stats(self) -> None:
+        self.primary.print_stats()
+        self.fallback.print_stats()
 
 def _query_img_captions_from_article(
     page_dir: Path,
     invalidate_cache: bool = False,
     language_code: str = 'en',
     debug_info: bool = False,
-) -> None:
+) -> bool:
     meta_path = join(page_dir, 'img', 'meta.json')
-    meta_arr = _getJSON(meta_path)['img_meta']
+    meta = _getJSON(meta_path)
+    meta_arr = meta['img_meta']
 
     if invalidate_cache:
         for m in meta_arr:
@@ -303,16 +917,16 @@ def _query_img_captions_from_article(
     page_html = _getJSON(text_path)['html']
     
     image_captions = _get_image_captions(page_html, language_code, debug_info)
+    img_index = _get_img_index(meta_arr)
     for filename, caption in image_captions:
         if not _valid_img_type(filename): continue
         
-        res = [i for i, x in enumerate(meta_arr) if unquote(x['url']).split('/wiki/')[-1] == filename]
-        if len(res) != 1:
+        if filename not in img_index:
             if debug_info : print('WARNING: Meta for page {} is missing the image {}. Either was'\
                 ' removed intentionally or cache is outdated'.format(page_dir, filename))
             continue
         
-        i = res[0]
+        i = img_index[filename]
         caption_match_description = (
             ('description' not in meta_arr[i]) or
             (caption != _remove_prefix(meta_arr[i]['description'], "English: "))
@@ -322,35 +936,37 @@ def _query_img_captions_from_article(
             meta_arr[i]['caption'] = caption
             meta_arr[i]['is_icon'] = False # preview only applies to not-icons
             
-    _dump(meta_path, {"img_meta": meta_arr})
+    return _dump_if_changed(meta_path, meta)
 
 # Time-consuming but exhoustive fetching of image captions. On the other hand,
 # fetch_meta_captions_fast is a fast alternative, although it misses around 20% of labels
 def _query_img_captions_from_preview(
     page_dir: Path,
-    driver: WebDriver,
-    icons: Set[str],
+    backend: _ICaptionBackend,
+    icons: _NameSet,
     language_code: str = 'en',
     debug_info: bool = False,
-) -> None:
+) -> bool:
     img_dir = _get_path(page_dir/"img", create_if_not_exists=False)
     meta_path = img_dir / 'meta.json'
-    meta_arr = _getJSON(meta_path)['img_meta']
+    meta = _getJSON(meta_path)
+    meta_arr = meta['img_meta']
         
     page_id = basename(page_dir)
     if page_id == '':
         page_id = basename(str(page_dir)[:-1])
 
-    for i, meta in enumerate(meta_arr):
-        img_title = meta['title']
+    file_label = _get_translated_file_label(language_code)
+    img_ids = {}
+    for i, img_meta in enumerate(meta_arr):
+        img_title = img_meta['title']
         if not _valid_img_type(img_title):
             continue
 
-        file_label = _get_translated_file_label(language_code)
         # TODO: here we extract img_id without language-specific File: prefix
         # and later on we add it again to build a URL. Check whether we could
         # work WITH that language-specific part and thus avoid translations
-        img_id = unquote(meta['url']).split('/wiki/{}'.format(file_label))[-1]
+        img_id = unquote(img_meta['url']).split('/wiki/{}'.format(file_label))[-1]
             
         if 'caption' in meta_arr[i]:
             if debug_info: print('Skipping cached caption', img_id) 
@@ -360,9 +976,22 @@ def _query_img_captions_from_preview(
             if debug_info: print('Skipping known icon', img_id) 
             continue
             
-        caption = _parse_caption_with_js(
-            driver, language_code, page_id, img_id, icons, debug_info
-        )
+        img_ids[i] = img_id
+        
+    unknown_ids = [
+        img_id for img_id in img_ids.values()
+        if img_id not in _KNOWN_ICONS and img_id not in icons
+    ]
+    captions = (
+        backend.get_captions(page_dir, page_id, unknown_ids)
+        if len(unknown_ids) > 0
+        else {}
+    )
+    
+    for i, img_id in img_ids.items():
+        caption = captions.get(img_id)
+        if img_id not in captions and debug_info:
+            print('Skipping known icon', img_id)
 
         if caption is None: icons.add(img_id)
         meta_arr[i].pop('caption', None)
@@ -376,28 +1005,25 @@ def _query_img_captions_from_preview(
         if caption and caption_match_description:
             meta_arr[i]['caption'] = caption
             
-    _dump(meta_path, {"img_meta": meta_arr})
+    return _dump_if_changed(meta_path, meta)
 
 # This function is firstly trying to parse as many captions as possible with 
 # a fast but unreliable approach. After that, it gathers all remaining captions
-# with a time-consuming method, which is to download HTML preview-pages for each
-# image in the article. Furthermore, it's dynamically generated content by
-# javascript. Thus we need to execute that generating code internally when
-# loading the page. Also generates 'is_icon' property for each field depending
-# whether image has a preview. Also, when caption matches description, we will
-# not record caption
+# from image previews with @backend, see FillPropertyParams.img_caption_backend.
+# Also generates 'is_icon' property for each field depending whether image has
+# a preview. Also, when caption matches description, we will not record caption
 def _query_img_captions(
     page_dir: Path,
-    driver: WebDriver,
-    icons: Set[str],
+    backend: _ICaptionBackend,
+    icons: _NameSet,
     language_code: str = 'en',
     invalidate_cache: bool = False,
     debug_info: bool = False,
-) -> None:
+) -> bool:
     if debug_info:
         print("\nQuerying available captions with fast approach")
 
-    _query_img_captions_from_article(
+    updated = _query_img_captions_from_article(
         page_dir=page_dir,
         language_code=language_code,
         invalidate_cache=invalidate_cache,
@@ -405,16 +1031,179 @@ def _query_img_captions(
     )
 
     if debug_info:
-        print("\nQuerying remaining unparsed captions with time-consuming approach\n")
+        print("\nQuerying remaining unparsed captions from image previews\n")
 
-    _query_img_captions_from_preview(
+    updated = _query_img_captions_from_preview(
         page_dir=page_dir,
-        driver=driver,
+        backend=backend,
         icons=icons,
         language_code=language_code,
         debug_info=debug_info
+    ) or updated
+    
+    return updated
+
+def _get_caption_backend(
+    params: "QueryParams", pool: _WebDriverPool
+) -> _ICaptionBackend:
+    backend_name = params.fill_property.img_caption_backend
+    html_backend = _HtmlCaptionBackend(
+        params.language_code, params.max_connections_per_host
     )
+    
+    if backend_name == 'html' and not params.fill_property.img_caption_selenium_fallback:
+        return html_backend
+    
+    selenium_backend = _SeleniumCaptionBackend(pool, params)
+    if backend_name == 'selenium':
+        return selenium_backend
+    
+    if backend_name == 'html':
+        return _FallbackCaptionBackend(html_backend, selenium_backend)
+    
+    raise Exception('Unknown caption backend {}. Supported values are "html"'\
+        ' and "selenium"'.format(backend_name))
 
+# Same as _query_article, but records the outcome in @state. Failed articles are
+# reported and skipped instead of stopping the whole query. Articles which
+# @state has as done are skipped, unless some cache is being invalidated or
+# their files are gone
+def _query_article_with_state(
+    i: int,
+    p: Page,
+    params: "QueryParams",
+    caption_backend: _ICaptionBackend,
+    icons: _NameSet,
+    revid: Optional[int],
+    state: CrawlState,
+    done: Set[str],
+    refreshed_imgs: _NameSet,
+) -> Tuple[int, int]:
+    article = p.title(as_filename=True).rstrip('.')
+    refresh = params.incremental or any(asdict(params.invalidate_cache).values())
+    page_dir = _get_page_dir(p, params)
+    is_stored = (
+        (page_dir / 'text.json').exists() and
+        (page_dir / 'img' / 'meta.json').exists()
+    )
+    if article in done and not refresh and is_stored:
+        if params.debug_info: print('\n{}) Skipping completed {}'.format(i, article))
+        return (0, 0)
+    
+    try:
+        tc, uc, status = _query_article(
+            i, p, params, caption_backend, icons, revid, state, refreshed_imgs
+        )
+    except Exception as e:
+        print('\nERROR: failed to download {} ||| {}'.format(article, str(e)))
+        state.set_article_status(article, _QUERY_STAGE, STATUS_FAILED, str(e))
+        return (0, 0)
+    
+    if status == _ARTICLE_MISSING:
+        error = 'Cannot fetch the page'
+        state.set_article_status(article, _QUERY_STAGE, STATUS_FAILED, error)
+    elif status == _ARTICLE_UPDATED:
+        # preprocessing of the article has to be repeated on the new data
+        state.reset_other_stages(article, _QUERY_STAGE)
+        state.set_article_status(article, _QUERY_STAGE, STATUS_DONE)
+    elif status == _ARTICLE_UNCHANGED:
+        state.set_article_status(article, _QUERY_STAGE, STATUS_DONE)
+        
+    return (tc, uc)
+
+# Downloads text, images and captions of the i-th article @p. Returns the number
+# of downloaded images, the number of those unavailable from commons and what
+# happened to the article, see _ARTICLE_UPDATED and others. Might be executed
+# concurrently for different articles
+def _query_article(
+    i: int,
+    p: Page,
+    params: "QueryParams",
+    caption_backend: _ICaptionBackend,
+    icons: _NameSet,
+    revid: Optional[int] = None,
+    state: Optional[CrawlState] = None,
+    refreshed_imgs: Optional[_NameSet] = None,
+) -> Tuple[int, int, str]:
+    if params.incremental and revid is not None:
+        page_dir = _get_page_dir(p, params)
+        up_to_date = _is_up_to_date(page_dir, revid)
+        if up_to_date and not any(asdict(params.invalidate_cache).values()):
+            if params.debug_info: print('\n{}) Skipping unchanged {}'.format(i, page_dir))
+            return (0, 0, _ARTICLE_UNCHANGED)
+        
+        if not up_to_date and (page_dir / 'text.json').exists():
+            # article was changed since it was downloaded
+            params = replace(params, invalidate_cache=replace(
+                params.invalidate_cache,
+                text_cache=True,
+                oudated_img_meta_cache=True,
+            ))
+            
+    if p.pageid == 0:
+        print("\nERROR: Cannot fetch the page " + p.title())
+        return (0, 0, _ARTICLE_MISSING)
+        
+    # onyshchak: create_if_not_exists - switch to enrich only existing data
+    page_dir = _get_path(
+        out_dir = _get_page_dir(p, params),
+        create_if_not_exists = not params.only_update_cached_pages
+    )
+    
+    if not page_dir.exists():
+        return (0, 0, _ARTICLE_SKIPPED)
+    
+    if params.debug_info: print('\n{}) {}'.format(i, page_dir))  
+    if params.verify_integrity:
+        _remove_damaged_files(page_dir, params.debug_info)
+        
+    should_download_article = lambda path: (
+        not path.exists() or
+        stat(path).st_size == 0 or
+        params.invalidate_cache.text_cache
+    )
+    
+    updated = False
+    text_path = page_dir / 'text.json'
+    if should_download_article(text_path):
+        if params.debug_info: print("Downloading text.json")
+        page_json = {
+            "title": p.title(),
+            "id": p.pageid,
+            "url": p.full_url(),
+        }
+        _with_revid(page_json, revid)
+
+        if params.fill_property.text_wikitext:
+            page_json["wikitext"] = p.text
+
+        if params.fill_property.text_html:
+            page_json["html"] = _fetch_text(p.full_url(), params.max_connections_per_host)
+         
+        updated = _dump_if_changed(text_path, page_json)
+        
+    # downloading page images
+    tc, uc, imgs_updated = _img_download(
+        p.imagelinks(), page_dir, params, 0, 0, state, refreshed_imgs
+    )
+    updated = updated or imgs_updated
+
+    if params.fill_property.img_caption:
+        updated = _query_img_captions(
+            page_dir=page_dir,
+            backend=caption_backend,
+            icons=icons,
+            language_code=params.language_code,
+            invalidate_cache=params.invalidate_cache.caption_cache,
+            debug_info=params.debug_info,
+        ) or updated
+    
+    # only now the article is complete, so that an interrupted one isn't
+    # skipped by the next incremental query
+    if revid is not None:
+        _stamp_revid(page_dir / 'img' / 'meta.json', revid)
+            
+    return (tc, uc, _ARTICLE_UPDATED if updated else _ARTICLE_UNCHANGED)
 
 
 ################################################################################
@@ -429,6 +1218,16 @@ class FillPropertyParams:
     # property, so it will only be present if you fill meta.json['captions']
     img_caption: bool = True
 
+    # source of captions for images, which don't have one in the article
+    # text. "html" reproduces the image preview from the article HTML, while
+    # "selenium" loads every preview in a headless Firefox, which is exact but
+    # takes seconds per image
+    img_caption_backend: str = 'html'
+
+    # if True, images for which "html" backend found no preview are checked
+    # once more with "selenium" backend
+    img_caption_selenium_fallback: bool = False
+
     # if False, will not download meta.json['description']
     img_description: bool = True
 
@@ -486,6 +1285,36 @@ class QueryParams:
     # update them
     only_update_cached_pages: bool = False
 
+    # if True, will skip articles which haven't changed since they were
+    # downloaded. That is, latest revision ids of all articles are queried in
+    # batches and compared with "lastrevid" of their meta.json. Changed
+    # articles are downloaded again as if @invalidate_cache.text_cache and
+    # @invalidate_cache.oudated_img_meta_cache were True. Nothing is skipped
+    # while any of @invalidate_cache parameters is True
+    incremental: bool = False
+
+    # path to SQLite database to record progress in, see state.CrawlState.
+    # If specified, articles recorded there as completed are skipped right
+    # away, unless some cache is invalidated, and articles which fail are
+    # recorded and skipped instead of stopping the query
+    state_db: Optional[str] = None
+
+    # number of nodes sharing the work. Every article goes to exactly one
+    # shard depending on the hash of its title, so several machines can write
+    # into the same @out_dir without collisions. @offset and @limit are then
+    # applied to articles of the shard. Known icons are saved per shard, merge
+    # them with utils.merge_known_icons once all shards have finished
+    num_shards: int = 1
+
+    # index of the shard processed by this node, from 0 to @num_shards - 1
+    shard_id: int = 0
+
+    # if True, will check every article before processing and remove files
+    # left damaged by an interrupted run, e.g. truncated meta.json, so that
+    # they are downloaded again. text.json is only checked to be non-empty,
+    # use utils.repair_dataset to parse all of them
+    verify_integrity: bool = True
+
     # set of parameters to configure what data to download. Please see the
     # FillPropertyParams definition above for more details
     fill_property : FillPropertyParams = FillPropertyParams()
@@ -505,6 +1334,71 @@ class QueryParams:
     # icons. Remove this flag if you want to get them
     early_icons_removal: bool = True
 
+    # number of articles processed concurrently. Works together with @offset
+    # and @limit, i.e. only articles from that range are distributed between
+    # workers
+    article_workers: int = 1
+
+    # maximum number of headless browsers loading image previews concurrently,
+    # if "selenium" caption backend is used. Browsers are only started once
+    # the first preview is requested
+    webdriver_pool_size: int = 1
+
+    # maximum time in seconds to wait for a caption to appear on an image
+    # preview page. Image without caption after that time is considered an icon
+    caption_wait_timeout: float = 5.0
+
+    # initial delay in seconds between checks whether a caption has appeared.
+    # Doubles after every check, up to a second
+    caption_poll_interval: float = 0.1
+
+    # number of images of a single article downloaded concurrently. Set to 1
+    # to download them one by one
+    img_download_workers: int = 4
+
+    # maximum number of simultaneous keep-alive connections to a single host,
+    # e.g. upload.wikimedia.org. Downloads above that limit wait for a free
+    # connection instead of opening a new one
+    max_connections_per_host: int = 4
+
+    # average number of requests per second sent to a single host, such as
+    # en.wikipedia.org or upload.wikimedia.org, by all workers together,
+    # including pywikibot and browsers. Set to 0 to disable the limit
+    requests_per_second: float = 10.0
+
+    # number of requests to a single host which may be sent at once after a
+    # pause, before @requests_per_second limit starts to apply
+    request_burst: int = 10
+
+    # number of retries of a request throttled by the server (HTTP 429 or 503)
+    # or failed to connect. Waits as long as the server asked in Retry-After,
+    # otherwise exponentially longer after every attempt
+    max_retries: int = 5
+
+    # directory to keep HTTP responses in, such as article HTML, image
+    # description pages and API replies. Cached responses are revalidated
+    # with the server and only downloaded again if they have changed.
+    # None disables the cache
+    http_cache_dir: Optional[str] = None
+
+    # if True, serves all requests from @http_cache_dir recorded by previous
+    # runs without using network at all, and fails requests missing there.
+    # Useful to rerun parsing with different parameters or to benchmark the
+    # pipeline. Image previews loaded by "selenium" caption backend are not
+    # cached, so use "html" backend instead
+    offline: bool = False
+
+    # if True, every image is downloaded once into @out_dir/_shared/img, which
+    # is addressed by the hash of image name, and article directories only
+    # contain hard links to it. Thus images used by many articles, such as
+    # flags or maps, are downloaded and stored only once
+    shared_img_store: bool = True
+
+    # if True, will fetch thumbnail urls and descriptions of article images
+    # with batched API requests for up to 50 files at once. Otherwise, will
+    # download an image description page for every image
+    batch_img_metadata: bool = True
+
 # queries wikipedia articles from the list specified by a @filename path. All
 # data collection details can be configured via @params.
 # @filename should be a path of a file with article ids specified one per line.
@@ -514,74 +1408,49 @@ class QueryParams:
 # file should be from the same Wikipedia, i.e. either all English or all Ukrainian.
 def query(filename: str, params: QueryParams) -> None:   
     site = pywikibot.Site(code=params.language_code, fam='wikipedia', user='pywikimm')    
-    pages = list(pagegenerators.TextfilePageGenerator(filename=filename, site=site))
-    limit = _validated_limit(params.limit, params.offset, len(pages))
-
-    icons: Set[str] = set()
+    _configure_rate_limit(
+        params.requests_per_second, params.request_burst, params.max_retries
+    )
+    _configure_http_cache(params.http_cache_dir, params.offline)
+    icons = _NameSet()
+    refreshed_imgs = _NameSet()
 
-    # TODO: don't execute driver when fill_captions=Flase
-    options = Options()
-    options.headless = True
-    driver = webdriver.Firefox(options=options)
+    driver_pool = _WebDriverPool(params.webdriver_pool_size)
+    caption_backend = _get_caption_backend(params, driver_pool)
     
-    print('Downloading... offset={}, limit={}'.format(params.offset, limit))
-    tc, uc = 0, 0
-    for i in range(params.offset, params.offset + limit):
-        p = pages[i]
-        if p.pageid == 0:
-            print("\nERROR: Cannot fetch the page " + p.title())
-            continue
-            
-        # onyshchak: create_if_not_exists - switch to enrich only existing data
-        page_dir = _get_path(
-            out_dir = params.out_dir + p.title(as_filename=True).rstrip('.'),
-            create_if_not_exists = not params.only_update_cached_pages
+    print('Downloading... offset={}, limit={}'.format(params.offset, params.limit))
+    state = CrawlState(params.state_db) if params.state_db else None
+    done = state.done_articles(_QUERY_STAGE) if state else set()
+    query_article = lambda x: (
+        _query_article_with_state(
+            x[0], x[1], params, caption_backend, icons, x[2], state, done,
+            refreshed_imgs,
         )
-        
-        if not page_dir.exists():
-            continue 
-        
-        if params.debug_info: print('\n{}) {}'.format(i, page_dir))  
-        should_download_article = lambda path: (
-            not path.exists() or
-            stat(path).st_size == 0 or
-            params.invalidate_cache.text_cache
+        if state
+        else _query_article(
+            x[0], x[1], params, caption_backend, icons, x[2], None, refreshed_imgs
+        )[:2]
+    )
+    
+    tc, uc = 0, 0
+    with ThreadPoolExecutor(max_workers=params.article_workers) as executor:
+        articles = _stream_pages(filename, site, params)
+        results = _bounded_map(
+            executor, query_article, articles, 2 * params.article_workers
         )
-        
-        text_path = page_dir / 'text.json'
-        if should_download_article(text_path):
-            if params.debug_info: print("Downloading text.json")
-            page_json = {
-                "title": p.title(),
-                "id": p.pageid,
-                "url": p.full_url(),
-            }
-
-            if params.fill_property.text_wikitext:
-                page_json["wikitext"] = p.text
-
-            if params.fill_property.text_html:
-                response = urllib.request.urlopen(p.full_url())
-                page_json["html"] = response.read().decode("utf-8")
-             
-            _dump(text_path, page_json)
-            
-        # downloading page images
-        tc, uc = _img_download(p.imagelinks(), page_dir, params, tc, uc)
-
-        if params.fill_property.img_caption:
-            _query_img_captions(
-                page_dir=page_dir,
-                driver=driver,
-                icons=icons,
-                language_code=params.language_code,
-                invalidate_cache=params.invalidate_cache.caption_cache,
-                debug_info=params.debug_info,
-            )
+        for dtc, duc in results:
+            tc, uc = tc + dtc, uc + duc
             
     print('\nDownloaded {} images, where {} of them unavailable from commons'.format(tc, uc))
-    driver.quit()
+    caption_backend.print_stats()
+    driver_pool.close()
+    if state:
+        print('Progress:', state.summary())
+        state.close()
 
-    icons_json = _getJSON(_KNOWN_ICONS_PATH)
-    updated_icons = icons.union(icons_json['known_icons'])
-    _dump(_KNOWN_ICONS_PATH, {"known_icons": list(updated_icons)})
+    icons_path = (
+        _get_known_icons_shard_path(params.out_dir, params.shard_id)
+        if params.num_shards > 1
+        else _KNOWN_ICONS_PATH
+    )
+    _update_known_icons(icons_path, icons.to_set())
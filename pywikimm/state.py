@@ -0,0 +1,147 @@
+# from __future__ import annotations  # optional, uncomment if py.version >= 3.7
+import sqlite3
+import threading
+import time
+
+from typing import Dict, Optional, Set
+
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS articles (
+    article TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    error TEXT,
+    retries INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (article, stage)
+);
+CREATE TABLE IF NOT EXISTS images (
+    article TEXT NOT NULL,
+    image TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    error TEXT,
+    retries INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (article, image, stage)
+);
+'''
+
+# two statements instead of a single UPSERT, which requires SQLite 3.24+
+_INSERT = '''
+INSERT OR IGNORE INTO {table} ({keys}, stage, status, updated_at)
+VALUES ({placeholders}, ?, ?, ?)
+'''
+
+_UPDATE = '''
+UPDATE {table} SET status = ?, updated_at = ?, error = ?, retries = retries + ?
+WHERE {conditions} AND stage = ?
+'''
+
+################################################################################
+# Public Interface
+################################################################################
+
+# Persistent record of the progress of data collection and preprocessing,
+# stored in a SQLite database at @path. For every article and every stage,
+# e.g. "query" or "HeadingsStage", keeps its status, time of the last update,
+# the last error and how many times it failed. Images are tracked the same way.
+# Could be shared between threads, but not between processes on different
+# machines, so use a separate database per node
+class CrawlState:
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+
+    def _set(
+        self,
+        table: str,
+        keys: Dict[str, str],
+        stage: str,
+        status: str,
+        error: Optional[str],
+    ) -> None:
+        insert = _INSERT.format(
+            table=table,
+            keys=', '.join(keys),
+            placeholders=', '.join('?' for _ in keys),
+        )
+        update = _UPDATE.format(
+            table=table,
+            conditions=' AND '.join('{} = ?'.format(x) for x in keys),
+        )
+        retries = 1 if status == STATUS_FAILED else 0
+        now = time.time()
+        with self._lock:
+            self._conn.execute(insert, list(keys.values()) + [stage, status, now])
+            self._conn.execute(
+                update,
+                [status, now, error, retries] + list(keys.values()) + [stage],
+            )
+            self._conn.commit()
+
+    def set_article_status(
+        self, article: str, stage: str, status: str, error: Optional[str] = None
+    ) -> None:
+        self._set('articles', {'article': article}, stage, status, error)
+
+    def set_image_status(
+        self,
+        article: str,
+        image: str,
+        stage: str,
+        status: str,
+        error: Optional[str] = None,
+    ) -> None:
+        keys = {'article': article, 'image': image}
+        self._set('images', keys, stage, status, error)
+
+    # forgets progress of all stages of @article except @stage, e.g. after the
+    # article was downloaded again and has to be preprocessed again
+    def reset_other_stages(self, article: str, stage: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                'DELETE FROM articles WHERE article = ? AND stage != ?',
+                (article, stage),
+            )
+            self._conn.commit()
+
+    # forgets progress of all stages of @article and of its images, e.g. after
+    # its damaged files were removed and have to be downloaded again
+    def reset_article(self, article: str) -> None:
+        with self._lock:
+            self._conn.execute('DELETE FROM articles WHERE article = ?', (article,))
+            self._conn.execute('DELETE FROM images WHERE article = ?', (article,))
+            self._conn.commit()
+
+    # returns all articles which completed @stage, so that callers can check
+    # any article in O(1) without further queries
+    def done_articles(self, stage: str) -> Set[str]:
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT article FROM articles WHERE stage = ? AND status = ?',
+                (stage, STATUS_DONE),
+            ).fetchall()
+        return set(x for x, in rows)
+
+    # returns a dict from stage to the number of articles in each status
+    def summary(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT stage, status, COUNT(*) FROM articles GROUP BY stage, status'
+            ).fetchall()
+
+        res: Dict[str, Dict[str, int]] = {}
+        for stage, status, count in rows:
+            res.setdefault(stage, {})[status] = count
+        return res
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
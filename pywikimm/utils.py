@@ -1,19 +1,239 @@
 # from __future__ import annotations  # optional, uncomment if py.version >= 3.7
+import glob
+import hashlib
 import json
+import os
 import pathlib
+import socket
+import threading
+import uuid
 import mwparserfromhell as mwp
-from typing import Tuple, Sequence, Union, Dict, Optional, Any
+from os import listdir
+from os.path import basename, isdir, join
+from urllib.parse import unquote
+from typing import Tuple, Sequence, Union, Dict, Optional, Any, Set
 from pywikimm import _KNOWN_ICONS_PATH, _KNOWN_ICONS
+from pywikimm.state import CrawlState
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 pathlike = Union[str, pathlib.Path]
 
+_TMP_SUFFIX = '.tmp'
+
+# directory inside the dataset with data shared between articles. It can't be
+# confused with an article, because Wikipedia titles never start with "_"
+_SHARED_DIR = '_shared'
+
+# matrix with visual features of article images, see preprocessor.VisualFeaturesStage
+_FEATURES_FILE = 'features.npy'
+
+def _loads(raw: bytes) -> "JSONType":
+    loads = orjson.loads if orjson else json.loads
+    data = loads(raw)
+    # files written by older versions are double-encoded, i.e. contain a JSON
+    # string with the actual JSON inside
+    if isinstance(data, str):
+        data = loads(data)
+    return data
+
+def _dumps(data: "JSONType") -> bytes:
+    if orjson:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False).encode('utf8')
+
+def _is_double_encoded(path: pathlike) -> bool:
+    with open(path, 'rb') as json_file:
+        return json_file.read(1) == b'"'
+
 def _getJSON(path: pathlike) -> "JSONType":
-    with open(path) as json_file:
-        return json.loads(json.load(json_file))
+    with open(path, 'rb') as json_file:
+        return _loads(json_file.read())
     
+# Writes @data into a temporary file next to @path and then atomically renames
+# it, so that @path always contains either old or new data, even if the process
+# is killed in the middle of writing
 def _dump(path: pathlike, data: "JSONType") -> None:
-    with open(path, 'w', encoding='utf8') as outfile:
-        json.dump(json.dumps(data), outfile, indent=2, ensure_ascii=False)
+    _write_atomic(path, _dumps(data))
+
+# Same as _dump, but leaves @path untouched if it already contains exactly the
+# same data, so that reprocessing unchanged articles doesn't rewrite them.
+# Returns True if the file was written
+def _dump_if_changed(path: pathlike, data: "JSONType") -> bool:
+    raw = _dumps(data)
+    try:
+        with open(path, 'rb') as json_file:
+            if json_file.read() == raw:
+                return False
+    except OSError:
+        pass
+    
+    _write_atomic(path, raw)
+    return True
+
+def _write_atomic(path: pathlike, raw: bytes) -> None:
+    tmp_path = _get_tmp_path(path)
+    try:
+        with open(tmp_path, 'wb') as outfile:
+            outfile.write(raw)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# sorted list of article directories of the dataset, see _get_article_paths
+_MANIFEST_FILE = 'articles.json'
+
+# Returns paths of all articles of the dataset in @data_path, sorted by name, so
+# that @offset and @limit of preprocessor functions always refer to the same
+# articles. The list is kept in a manifest in the _shared directory together
+# with modification time of @data_path. That time only changes when articles
+# are added or removed, so until then the manifest is used as is. Otherwise,
+# only entries missing from the manifest are checked to be directories
+def _get_article_paths(data_path: str) -> Sequence[str]:
+    manifest_path = join(data_path, _SHARED_DIR, _MANIFEST_FILE)
+    try:
+        # created before taking the time, since that changes it as well
+        os.makedirs(join(data_path, _SHARED_DIR), exist_ok=True)
+    except OSError:
+        pass  # e.g. read-only dataset, then it's listed every time
+    
+    # taken before listing, so that articles added meanwhile cause a refresh
+    mtime = os.stat(data_path).st_mtime_ns
+    try:
+        manifest = _getJSON(manifest_path)
+    except (OSError, ValueError, UnicodeDecodeError):
+        manifest = {'mtime': None, 'articles': []}
+        
+    if manifest['mtime'] != mtime:
+        known = set(manifest['articles'])
+        articles = []
+        with os.scandir(data_path) as entries:
+            for entry in entries:
+                if entry.name in known or (
+                    entry.name != _SHARED_DIR and entry.is_dir()
+                ):
+                    articles.append(entry.name)
+                    
+        manifest = {'mtime': mtime, 'articles': sorted(articles)}
+        try:
+            _dump(manifest_path, manifest)
+        except OSError:
+            pass
+            
+    return [join(data_path, f) for f in manifest['articles']]
+
+# Returns a path in the content-addressed store @kind of the dataset in
+# @data_path for an entry named @filename, which starts with an md5 hash.
+# Entries are spread into subdirectories by hash prefix, the same way as
+# upload.wikimedia.org does, to keep directories small
+def _get_shared_path(data_path: pathlike, kind: str, filename: str) -> pathlib.Path:
+    return pathlib.Path(data_path, _SHARED_DIR, kind, filename[0], filename[:2], filename)
+
+# Returns a unique path of a temporary file next to @path. Several nodes may
+# write the same file of a shared dataset at once and their pids or thread ids
+# may coincide, so the name also contains host name and a random token
+def _get_tmp_path(path: pathlike) -> str:
+    return '{}.{}.{}.{}.{}{}'.format(
+        path,
+        socket.gethostname(),
+        os.getpid(),
+        threading.get_ident(),
+        uuid.uuid4().hex[:8],
+        _TMP_SUFFIX,
+    )
+
+def _is_valid_json(path: pathlike) -> bool:
+    try:
+        _getJSON(path)
+        return True
+    except (ValueError, UnicodeDecodeError):
+        return False
+
+# Removes files of the article in @article_path left damaged by an interrupted
+# run, i.e. unfinished temporary files and text.json or meta.json which cannot
+# be parsed. Returns True if the article was damaged. Once removed, those files
+# are downloaded again by the next reader.query run. Unless @full is True,
+# text.json is only checked to be non-empty, since it holds the whole article
+# and is much larger than meta.json
+def _remove_damaged_files(
+    article_path: pathlike, debug_info: bool = False, full: bool = False
+) -> bool:
+    is_valid = lambda f, path: (
+        os.path.getsize(path) > 0
+        if f == 'text.json' and not full
+        else _is_valid_json(path)
+    )
+    
+    res = False
+    for dir_path in [article_path, join(article_path, 'img')]:
+        if not isdir(dir_path):
+            continue
+        
+        for f in listdir(dir_path):
+            path = join(dir_path, f)
+            is_damaged = (
+                f.endswith(_TMP_SUFFIX) or
+                (f in ('text.json', 'meta.json') and not is_valid(f, path))
+            )
+            if is_damaged:
+                if debug_info: print('Removing damaged file', path)
+                os.remove(path)
+                res = True
+                
+    return res
+
+# Returns True if article @title belongs to shard @shard_id out of @num_shards.
+# Depends only on the title, so every node gets the same split of the same
+# input file without coordination
+def _in_shard(title: str, shard_id: int, num_shards: int) -> bool:
+    if num_shards <= 1:
+        return True
+    
+    key = title.strip().replace('_', ' ').encode('utf-8')
+    return int(hashlib.md5(key).hexdigest(), 16) % num_shards == shard_id
+
+_ICONS_SHARD_PREFIX = 'known_icons.shard'
+
+# Returns path of icons found by shard @shard_id, stored in the dataset itself,
+# so that all nodes put them in the same place
+def _get_known_icons_shard_path(data_path: pathlike, shard_id: int) -> str:
+    filename = '{}{}.json'.format(_ICONS_SHARD_PREFIX, shard_id)
+    return join(data_path, _SHARED_DIR, filename)
+
+# Adds @icons to known icons in @path, creating it if missing
+def _update_known_icons(path: str, icons: Set[str]) -> None:
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    if os.path.isfile(path):
+        icons = icons.union(_getJSON(path)['known_icons'])
+    _dump(path, {"known_icons": sorted(icons)})
+
+# Returns name of the image described by @img_meta entry of meta.json as it
+# appears in article links, e.g. "File:Foo bar.jpg"
+def _get_meta_img_name(img_meta: "JSONType") -> str:
+    return unquote(img_meta['url']).split('/wiki/')[-1]
+
+# Builds index of @meta_arr from image name, see _get_meta_img_name, to the
+# position of its entry, so that images found in the article can be matched to
+# their meta in O(1). Names which occur more than once are ambiguous and
+# therefore left out, the same as missing ones
+def _get_img_index(meta_arr: Sequence["JSONType"]) -> Dict[str, int]:
+    res: Dict[str, int] = {}
+    duplicates: Set[str] = set()
+    for i, img_meta in enumerate(meta_arr):
+        name = _get_meta_img_name(img_meta)
+        if name in res:
+            duplicates.add(name)
+        res[name] = i
+        
+    for name in duplicates:
+        del res[name]
+    return res
 
 def _valid_img_type(img_name: str, early_icon_removal: bool = False) -> bool:
     if early_icon_removal and img_name in _KNOWN_ICONS:
@@ -73,3 +293,60 @@ JSONSerializableType = Union[JSONCompoundType, JSONCompoundType, JSONType]
 def parse_wikitext(wikitext: str) -> str:
     wikicode = mwp.parse(wikitext)
     return wikicode.strip_code()
+
+# Rewrites text.json and meta.json files of the dataset in @data_path, which
+# were saved by older versions as double-encoded JSON, i.e. a JSON string
+# containing escaped JSON. Reading such files is still supported, but they are
+# twice as slow to parse and larger on disk. Returns number of migrated files
+def migrate_dataset(data_path: str, debug_info: bool = False) -> int:
+    res = 0
+    for path in _get_article_paths(data_path):
+        for json_path in [join(path, 'text.json'), join(path, 'img', 'meta.json')]:
+            if not os.path.isfile(json_path) or not _is_double_encoded(json_path):
+                continue
+
+            if debug_info: print('Migrating', json_path)
+            _dump(json_path, _getJSON(json_path))
+            res += 1
+
+    return res
+
+# Sharded queries (see reader.QueryParams.num_shards) don't update known icons
+# file directly, because several nodes would overwrite each other's changes.
+# Instead, every shard saves icons it found into the dataset in @data_path.
+# Once all shards have finished, call this function to merge them into the
+# known icons file. Returns number of merged shard files
+def merge_known_icons(data_path: str) -> int:
+    pattern = join(data_path, _SHARED_DIR, _ICONS_SHARD_PREFIX + '*')
+    shard_paths = [x for x in glob.glob(pattern) if not x.endswith(_TMP_SUFFIX)]
+    icons: Set[str] = set()
+    for path in shard_paths:
+        icons.update(_getJSON(path)['known_icons'])
+        
+    _update_known_icons(_KNOWN_ICONS_PATH, icons)
+    for path in shard_paths:
+        os.remove(path)
+        
+    return len(shard_paths)
+
+# Scans every article of the dataset in @data_path and removes files left
+# damaged by interrupted runs, so that reader.query downloads them again.
+# Unlike QueryParams.verify_integrity, parses every text.json. If @state_db is specified, progress of damaged articles recorded there is
+# reset as well, see state.CrawlState. Returns paths of damaged articles
+def repair_dataset(
+    data_path: str, debug_info: bool = False, state_db: Optional[str] = None
+) -> Sequence[str]:
+    damaged = [
+        path for path in _get_article_paths(data_path)
+        if _remove_damaged_files(path, debug_info, full=True)
+    ]
+    
+    if state_db and len(damaged) > 0:
+        state = CrawlState(state_db)
+        try:
+            for path in damaged:
+                state.reset_article(basename(path))
+        finally:
+            state.close()
+            
+    return damaged